@@ -0,0 +1,131 @@
+#Read-only access to archive files (cas, sb) through a pool of shared handles.
+#Opening and closing an archive for every payload costs two syscalls each time and there are hundreds of thousands of payloads,
+#so handles are kept open in an LRU pool. Reads are offset-based (pread) so any number of threads can share one descriptor.
+import os
+import io
+import threading
+import collections
+
+#Maximum number of archives kept open at once.
+maxOpenFiles=64
+
+class ArchiveFile:
+    """One open archive. Reads don't move any shared file position."""
+    def __init__(self,path):
+        self.path=path
+        self.fd=os.open(path,os.O_RDONLY|getattr(os,"O_BINARY",0))
+        self.size=os.fstat(self.fd).st_size
+        self.users=0
+        self.evicted=False
+        self.lock=threading.Lock() #only used where pread is not available (Windows)
+
+    def readAt(self,offset,size):
+        if hasattr(os,"pread"):
+            data=os.pread(self.fd,size,offset)
+            if len(data)==size: return data
+        else:
+            with self.lock:
+                os.lseek(self.fd,offset,os.SEEK_SET)
+                data=os.read(self.fd,size)
+
+        #Reads may come back short, keep going until EOF.
+        while len(data)<size:
+            if hasattr(os,"pread"):
+                chunk=os.pread(self.fd,size-len(data),offset+len(data))
+            else:
+                with self.lock:
+                    os.lseek(self.fd,offset+len(data),os.SEEK_SET)
+                    chunk=os.read(self.fd,size-len(data))
+            if not chunk: break
+            data+=chunk
+        return data
+
+    def close(self):
+        os.close(self.fd)
+
+class FilePool:
+    def __init__(self):
+        self.files=collections.OrderedDict() #path -> ArchiveFile, least recently used first
+        self.lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def acquire(self,path):
+        with self.lock:
+            handle=self.files.get(path)
+            if handle:
+                self.files.move_to_end(path)
+                self.hits+=1
+            else:
+                handle=ArchiveFile(path)
+                self.files[path]=handle
+                self.misses+=1
+                while len(self.files)>maxOpenFiles:
+                    oldPath, old = self.files.popitem(last=False)
+                    self.evictions+=1
+                    old.evicted=True
+                    if old.users==0: old.close() #otherwise closed by the last user
+
+            handle.users+=1
+            return handle
+
+    def release(self,handle):
+        with self.lock:
+            handle.users-=1
+            if handle.evicted and handle.users==0:
+                handle.close()
+
+    def closeAll(self):
+        with self.lock:
+            for handle in self.files.values():
+                handle.evicted=True
+                if handle.users==0: handle.close()
+            self.files.clear()
+
+    def takeStats(self):
+        #Return (hits, misses, evictions) since the last call and reset them.
+        with self.lock:
+            stats=self.hits, self.misses, self.evictions
+            self.hits=self.misses=self.evictions=0
+            return stats
+
+pool=FilePool()
+
+class FileReader(io.RawIOBase):
+    """Raw reader over a pooled archive with its own position, openFile() wraps it in a buffer like open(path,"rb") does."""
+    def __init__(self,path):
+        self.handle=pool.acquire(path)
+        self.name=path
+        self.pos=0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self,buf):
+        view=memoryview(buf).cast("B")
+        data=self.handle.readAt(self.pos,len(view))
+        view[:len(data)]=data
+        self.pos+=len(data)
+        return len(data)
+
+    def seek(self,offset,whence=0):
+        if whence==0: self.pos=offset
+        elif whence==1: self.pos+=offset
+        else: self.pos=self.handle.size+offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.handle:
+            pool.release(self.handle)
+            self.handle=None
+        super().close()
+
+def openFile(path):
+    return io.BufferedReader(FileReader(path))
@@ -5,6 +5,12 @@ from struct import unpack
 import io
 from collections import OrderedDict
 
+def xorData(encryptedData,key):
+    #XOR the data with a repeating key. Done on big integers in one go, a loop over the bytes takes seconds on big cats.
+    size=len(encryptedData)
+    keyStream=(bytes(key)*(size//len(key)+1))[:size]
+    return bytearray((int.from_bytes(encryptedData,"little")^int.from_bytes(keyStream,"little")).to_bytes(size,"little"))
+
 def unXor(path):
     """Take a filename (usually toc or cat), decrypt the file if necessary, close it and return the unencrypted data in a memory stream.
 
@@ -15,11 +21,7 @@ def unXor(path):
     if magic in (b"\x00\xD1\xCE\x00",b"\x00\xD1\xCE\x01"): #the file is XOR encrypted and has a signature
         f.seek(296) #skip the signature
         key=[f.read(1)[0]^0x7b for i in range(260)] #bytes 257 258 259 are not used
-        encryptedData=f.read()
-        size=len(encryptedData)
-        data=bytearray(size) #initalize the buffer
-        for i in range(size):
-            data[i]=key[i%257]^encryptedData[i]
+        data=xorData(f.read(),key[:257])
     else: #the file is not encrypted; no key + no signature
         f.seek(0)
         data=f.read()
@@ -4,7 +4,9 @@
 import dbo
 import noncas
 import ebx
+import archive
 import os
+import struct
 from struct import pack,unpack
 import io
 import sys
@@ -12,6 +14,7 @@ import zlib
 import subprocess
 import shutil
 import res
+import multiprocessing
 
 #Adjust paths here.
 #do yourself a favor and don't dump into the Users folder (or it might complain about permission)
@@ -19,6 +22,9 @@ import res
 gameDirectory   = r"D:\Games\OriginGames\Need for Speed The Run"
 targetDirectory = r"E:\GameRips\NFS\NFSTR\pc\dump"
 
+#Number of processes used to dump TOC files in parallel, 1 dumps them one at a time.
+numProcesses    = 1
+
 #####################################
 #####################################
 
@@ -35,6 +41,26 @@ def lp(path): #long pathnames
     if path[:4]=='\\\\?\\' or path=="" or len(path)<=247: return path
     return '\\\\?\\' + os.path.normpath(path)
 
+def tempPath(path):
+    #Payloads are written under a temporary name first so other processes never see a partially written file.
+    return "%s.%d.tmp" % (path,os.getpid())
+
+def commitFile(tmpPath,path):
+    #Move a finished file in place. A file that's there already is kept, so the first process to extract it wins rather than
+    #the last one: a hard link (a rename on Windows) fails if the file exists, unlike os.replace.
+    try:
+        if os.name=="nt":
+            os.rename(lp(tmpPath),lp(path))
+        else:
+            os.link(lp(tmpPath),lp(path))
+            os.remove(lp(tmpPath))
+    except FileExistsError:
+        #Another process has extracted the same file in the meantime.
+        os.remove(lp(tmpPath))
+    except OSError:
+        if os.path.isfile(lp(tmpPath)): os.remove(lp(tmpPath))
+        raise
+
 
 
 def dump(tocPath,outPath,baseTocPath=None,commonDatPath=None):
@@ -162,21 +188,24 @@ def dump(tocPath,outPath,baseTocPath=None,commonDatPath=None):
 def casBundlePayload(entry,outPath,compressed):
     if os.path.isfile(lp(outPath)): return
 
-    out=open2(outPath,"wb")
+    tmpPath=tempPath(outPath)
+    out=open2(tmpPath,"wb")
     catEntry=cat[entry.get("sha1")]
-    cas=open(catEntry.path,"rb")
+    cas=archive.openFile(catEntry.path)
     cas.seek(catEntry.offset)
     if compressed: out.write(zlibb(cas,catEntry.size))
     else:          out.write(cas.read(catEntry.size))
     cas.close()
     out.close()
+    commitFile(tmpPath,outPath)
 
 def casChunkPayload(entry,outPath):
     if os.path.isfile(lp(outPath)): return
 
     catEntry=cat[entry.get("sha1")]
-    out=open2(outPath,"wb")
-    cas=open(catEntry.path,"rb")
+    tmpPath=tempPath(outPath)
+    out=open2(tmpPath,"wb")
+    cas=archive.openFile(catEntry.path)
     cas.seek(catEntry.offset)
     if entry.get("id").isChunkCompressed():
         out.write(zlibb(cas,catEntry.size))
@@ -184,28 +213,33 @@ def casChunkPayload(entry,outPath):
         out.write(cas.read(catEntry.size))
     cas.close()
     out.close()
+    commitFile(tmpPath,outPath)
 
 def noncasBundlePayload(sb,entry,outPath,compressed):
     if os.path.isfile(lp(outPath)): return
 
     sb.seek(entry.offset)
-    out=open2(outPath,"wb")
+    tmpPath=tempPath(outPath)
+    out=open2(tmpPath,"wb")
     if compressed:
         out.write(zlibb(sb,entry.size))
     else:
         out.write(sb.read(entry.size))
     out.close()
+    commitFile(tmpPath,outPath)
 
 def noncasChunkPayload(sb,entry,outPath):
     if os.path.isfile(lp(outPath)): return
 
     sb.seek(entry.get("offset"))
-    out=open2(outPath,"wb")
+    tmpPath=tempPath(outPath)
+    out=open2(tmpPath,"wb")
     if entry.get("id").isChunkCompressed():
         out.write(zlibb(sb,entry.get("size")))
     else:
         out.write(sb.read(entry.get("size")))
     out.close()
+    commitFile(tmpPath,outPath)
 
 #zlib:
 #Compressed files are split into blocks which are then zlibbed individually (prefixed with compressed and uncompressed size)
@@ -257,104 +291,163 @@ def openSbFile(sbPath):
 #Take a dict and fill it using a cat file: sha1 vs (offset, size, cas path)
 #Cat files are always little endian.
 class CatEntry:
-    def __init__(self,f,casDirectory):
-        self.sha1=f.read(20)
-        self.offset, self.size, casNum = unpack("<III",f.read(12))
-        self.path=os.path.join(casDirectory,"cas_%02d.cas" % casNum)
+    def __init__(self,sha1,offset,size,path):
+        self.sha1=sha1
+        self.offset=offset
+        self.size=size
+        self.path=path
 
 def readCat(catDict, catPath):
     cat=dbo.unXor(catPath)
-    cat.seek(0,2) #get eof
-    catSize=cat.tell()
-    cat.seek(16) #skip nyan
     casDirectory=os.path.dirname(catPath)
-    while cat.tell()!=catSize:
-        catEntry=CatEntry(cat,casDirectory)
-        catDict[catEntry.sha1]=catEntry
+    casPaths=dict()
+
+    #Entries have a fixed size so they're all unpacked in one go, straight from the decrypted data.
+    data=cat.getbuffer()
+    for sha1, offset, size, casNum in struct.iter_unpack("<20sIII",data[16:]): #skip nyan
+        path=casPaths.get(casNum)
+        if not path:
+            path=casPaths[casNum]=os.path.join(casDirectory,"cas_%02d.cas" % casNum)
+        catDict[sha1]=CatEntry(sha1,offset,size,path)
+    data.release()
 
 def dumpRoot(dataDir,patchDir,outPath):
     os.makedirs(outPath,exist_ok=True)
     commonDatPath=os.path.join(patchDir,"common.dat")
 
+    #Patched TOC is always extracted before the unpatched one so keep them together in a single job.
+    jobs=list()
     for dir0, dirs, ff in os.walk(dataDir):
         for fname in ff:
             if fname[-4:]==".toc":
                 fname=os.path.join(dir0,fname)
                 localPath=os.path.relpath(fname,dataDir)
-                print(localPath)
 
                 #Check if there's a patched version and extract it first.
                 patchedName=os.path.join(patchDir,localPath)
-                if os.path.isfile(patchedName):
-                    dump(patchedName,outPath,fname,commonDatPath)
-
-                dump(fname,outPath)
-
-
-#make the paths absolute and normalize the slashes
-gameDirectory=os.path.normpath(gameDirectory)
-targetDirectory=os.path.normpath(targetDirectory) #it's an absolute path already
-
-tempDirectory=os.path.join(targetDirectory,"temp")
-
-dataDir=os.path.join(gameDirectory,"Data")
-updateDir=os.path.join(gameDirectory,"Update")
-patchDir=os.path.join(updateDir,"Patch","Data")
-
-print("Loading RES names...")
-res.loadResNames()
-
-#read cat file
-cat=dict()
-catPath=os.path.join(dataDir,"cas.cat") #Seems to always be in the same place.
-if os.path.isfile(catPath):
-    print("Reading cat entries...")
-    readCat(cat,catPath)
-
-    #Check if there's a patched version.
-    patchedCat=os.path.join(patchDir,os.path.relpath(catPath,dataDir))
-    if os.path.isfile(patchedCat):
-        print("Reading patched cat entries...")
-        readCat(cat,patchedCat)
-
-if os.path.isdir(updateDir):
-    #First, extract all DLCs.
-    for dir in os.listdir(updateDir):
-        if dir=="Patch":
-            continue
+                if not os.path.isfile(patchedName):
+                    patchedName=None
+
+                jobs.append((localPath,fname,patchedName,outPath,commonDatPath))
+
+    if numProcesses<=1:
+        for job in jobs:
+            print(job[0])
+            dumpJob(job)
+        return
+
+    #Each worker fills its own EBX GUID and RES tables, merge them in the same order the TOCs would be dumped in one by one.
+    pool=multiprocessing.Pool(numProcesses,initDumpWorker,(cat,gameDirectory,tempDirectory))
+    for localPath, guidTable, resTable, unkResTypes, stats in pool.imap(dumpWorker,jobs):
+        print(localPath)
+        addArchiveStats(stats)
+        ebx.guidTable.update(guidTable)
+        res.resTable.update(resTable)
+        for typ in unkResTypes:
+            if typ not in res.unkResTypes:
+                res.unkResTypes.append(typ)
+    pool.close()
+    pool.join()
+
+def dumpJob(job):
+    localPath, fname, patchedName, outPath, commonDatPath = job
+    if patchedName:
+        dump(patchedName,outPath,fname,commonDatPath)
+
+    dump(fname,outPath)
+
+def initDumpWorker(catDict,gameDir,tempDir):
+    global cat, gameDirectory, tempDirectory
+    cat=catDict
+    gameDirectory=gameDir
+    tempDirectory=os.path.join(tempDir,"%d" % os.getpid()) #dump() cleans it up, so don't share it with other workers
+    res.loadResNames()
+
+def dumpWorker(job):
+    ebx.guidTable.clear()
+    ebx.parsedEbx.clear()
+    res.resTable.clear()
+    res.unkResTypes.clear()
+    dumpJob(job)
+    return job[0], ebx.guidTable, res.resTable, res.unkResTypes, archive.pool.takeStats()
 
-        print("Extracting DLC %s..." % dir)
-        dumpRoot(os.path.join(updateDir,dir,"Data"),patchDir,targetDirectory)
+#Archive handle pool hits, misses and evictions summed over all processes.
+archiveStats=[0,0,0]
 
-#Now extract the base game.
-print("Extracting main game...")
-dumpRoot(dataDir,patchDir,targetDirectory)
+def addArchiveStats(stats):
+    for i in range(3):
+        archiveStats[i]+=stats[i]
 
-if not os.path.isdir(targetDirectory):
-    print("Nothing was extracted, did you set input path correctly?")
-    sys.exit(1)
 
-print("Writing EBX GUID table...")
-ebx.writeGuidTable(targetDirectory)
+if __name__=="__main__":
+    #make the paths absolute and normalize the slashes
+    gameDirectory=os.path.normpath(gameDirectory)
+    targetDirectory=os.path.normpath(targetDirectory) #it's an absolute path already
 
-print ("Writing RES table...")
-res.writeResTable(targetDirectory)
+    tempDirectory=os.path.join(targetDirectory,"temp")
 
-#MOH:WF hack: extract driving levels assets.
-if os.path.isdir(os.path.join(gameDirectory,"game","Speed")):
-    print("Extracting MOH:WF driving assets...")
-    gameDirectory=os.path.join(gameDirectory,"game")
-    targetDirectory=os.path.join(targetDirectory,"speed")
-    dataDir=os.path.join(gameDirectory,"Speed")
+    dataDir=os.path.join(gameDirectory,"Data")
     updateDir=os.path.join(gameDirectory,"Update")
-    patchDir=os.path.join(updateDir,"Patch","Speed")
-    ebx.guidTable.clear()
-    res.resTable.clear()
-    res.unkResTypes.clear()
+    patchDir=os.path.join(updateDir,"Patch","Data")
+
+    print("Loading RES names...")
+    res.loadResNames()
+
+    #read cat file
+    cat=dict()
+    catPath=os.path.join(dataDir,"cas.cat") #Seems to always be in the same place.
+    if os.path.isfile(catPath):
+        print("Reading cat entries...")
+        readCat(cat,catPath)
+
+        #Check if there's a patched version.
+        patchedCat=os.path.join(patchDir,os.path.relpath(catPath,dataDir))
+        if os.path.isfile(patchedCat):
+            print("Reading patched cat entries...")
+            readCat(cat,patchedCat)
+
+    if os.path.isdir(updateDir):
+        #First, extract all DLCs.
+        for dir in os.listdir(updateDir):
+            if dir=="Patch":
+                continue
+
+            print("Extracting DLC %s..." % dir)
+            dumpRoot(os.path.join(updateDir,dir,"Data"),patchDir,targetDirectory)
+
+    #Now extract the base game.
+    print("Extracting main game...")
     dumpRoot(dataDir,patchDir,targetDirectory)
 
+    if not os.path.isdir(targetDirectory):
+        print("Nothing was extracted, did you set input path correctly?")
+        sys.exit(1)
+
     print("Writing EBX GUID table...")
     ebx.writeGuidTable(targetDirectory)
 
     print ("Writing RES table...")
     res.writeResTable(targetDirectory)
+
+    #MOH:WF hack: extract driving levels assets.
+    if os.path.isdir(os.path.join(gameDirectory,"game","Speed")):
+        print("Extracting MOH:WF driving assets...")
+        gameDirectory=os.path.join(gameDirectory,"game")
+        targetDirectory=os.path.join(targetDirectory,"speed")
+        dataDir=os.path.join(gameDirectory,"Speed")
+        updateDir=os.path.join(gameDirectory,"Update")
+        patchDir=os.path.join(updateDir,"Patch","Speed")
+        ebx.guidTable.clear()
+        res.resTable.clear()
+        res.unkResTypes.clear()
+        dumpRoot(dataDir,patchDir,targetDirectory)
+
+        print("Writing EBX GUID table...")
+        ebx.writeGuidTable(targetDirectory)
+
+        print ("Writing RES table...")
+        res.writeResTable(targetDirectory)
+
+    addArchiveStats(archive.pool.takeStats())
+    print("Archive handles: %d hits, %d misses, %d evictions" % tuple(archiveStats))
+    archive.pool.closeAll()
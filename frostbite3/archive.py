@@ -0,0 +1,239 @@
+#Read-only access to archive files (cas, sb, das) through a pool of shared handles.
+#Opening and closing an archive for every payload costs two syscalls each time and there are hundreds of thousands of payloads,
+#so handles are kept open in an LRU pool. Reads are offset-based (pread) so any number of threads can share one descriptor.
+import os
+import io
+import mmap
+import struct
+import threading
+import collections
+
+#Maximum number of archives kept open at once.
+maxOpenFiles=64
+
+#Map archives into memory instead of reading them. Block headers are then unpacked straight from the map
+#and compressed data goes to the codecs without being copied. Needs a 64-bit Python for big cas archives.
+useMmap=False
+
+class ArchiveFile:
+    """One open archive. Reads don't move any shared file position."""
+    def __init__(self,path):
+        self.path=path
+        self.fd=os.open(path,os.O_RDONLY|getattr(os,"O_BINARY",0))
+        self.size=os.fstat(self.fd).st_size
+        self.users=0
+        self.evicted=False
+        self.lock=threading.Lock() #only used where pread is not available (Windows)
+        self.map=None
+        self.view=None
+
+    def getView(self):
+        #Map the file on first use. Copy-on-write so the views are writable for ctypes, nothing is ever written though.
+        with self.lock:
+            if self.view is None:
+                if self.size:
+                    self.map=mmap.mmap(self.fd,0,access=mmap.ACCESS_COPY)
+                    self.view=memoryview(self.map)
+                else:
+                    self.view=memoryview(b"") #empty files can't be mapped
+            return self.view
+
+    def readAt(self,offset,size):
+        if hasattr(os,"pread"):
+            data=os.pread(self.fd,size,offset)
+            if len(data)==size: return data
+        else:
+            with self.lock:
+                os.lseek(self.fd,offset,os.SEEK_SET)
+                data=os.read(self.fd,size)
+
+        #Reads may come back short, keep going until EOF.
+        while len(data)<size:
+            if hasattr(os,"pread"):
+                chunk=os.pread(self.fd,size-len(data),offset+len(data))
+            else:
+                with self.lock:
+                    os.lseek(self.fd,offset+len(data),os.SEEK_SET)
+                    chunk=os.read(self.fd,size-len(data))
+            if not chunk: break
+            data+=chunk
+        return data
+
+    def close(self):
+        if self.map:
+            try:
+                self.view.release()
+                self.map.close()
+            except BufferError:
+                pass #block data is still referenced somewhere, the map goes away with the last view
+        os.close(self.fd)
+
+class FilePool:
+    def __init__(self):
+        self.files=collections.OrderedDict() #path -> ArchiveFile, least recently used first
+        self.lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def acquire(self,path):
+        with self.lock:
+            handle=self.files.get(path)
+            if handle:
+                self.files.move_to_end(path)
+                self.hits+=1
+            else:
+                handle=ArchiveFile(path)
+                self.files[path]=handle
+                self.misses+=1
+                while len(self.files)>maxOpenFiles:
+                    oldPath, old = self.files.popitem(last=False)
+                    self.evictions+=1
+                    old.evicted=True
+                    if old.users==0: old.close() #otherwise closed by the last user
+
+            handle.users+=1
+            return handle
+
+    def release(self,handle):
+        with self.lock:
+            handle.users-=1
+            if handle.evicted and handle.users==0:
+                handle.close()
+
+    def closeAll(self):
+        with self.lock:
+            for handle in self.files.values():
+                handle.evicted=True
+                if handle.users==0: handle.close()
+            self.files.clear()
+
+    def takeStats(self):
+        #Return (hits, misses, evictions) since the last call and reset them.
+        with self.lock:
+            stats=self.hits, self.misses, self.evictions
+            self.hits=self.misses=self.evictions=0
+            return stats
+
+pool=FilePool()
+
+class FileReader(io.RawIOBase):
+    """Raw reader over a pooled archive with its own position, openFile() wraps it in a buffer like open(path,"rb") does."""
+    def __init__(self,path):
+        self.handle=pool.acquire(path)
+        self.name=path
+        self.pos=0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self,buf):
+        view=memoryview(buf).cast("B")
+        data=self.handle.readAt(self.pos,len(view))
+        view[:len(data)]=data
+        self.pos+=len(data)
+        return len(data)
+
+    def seek(self,offset,whence=0):
+        if whence==0: self.pos=offset
+        elif whence==1: self.pos+=offset
+        else: self.pos=self.handle.size+offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.handle:
+            pool.release(self.handle)
+            self.handle=None
+        super().close()
+
+class MappedReader:
+    """File-like reader over a memory-mapped archive. Besides the usual methods it can hand out views into the map without copying."""
+    def __init__(self,path):
+        self.handle=pool.acquire(path)
+        self.view=self.handle.getView()
+        self.name=path
+        self.pos=0
+
+    def read(self,size=-1):
+        if size is None or size<0:
+            size=len(self.view)-self.pos
+        data=self.view[self.pos:self.pos+size].tobytes()
+        self.pos+=len(data)
+        return data
+
+    def readinto(self,buf):
+        view=memoryview(buf).cast("B")
+        data=self.view[self.pos:self.pos+len(view)]
+        view[:len(data)]=data
+        self.pos+=len(data)
+        return len(data)
+
+    def readView(self,size):
+        #Only valid while the reader is open.
+        data=self.view[self.pos:self.pos+size]
+        self.pos+=len(data)
+        return data
+
+    def unpackFrom(self,fmt):
+        values=struct.unpack_from(fmt,self.view,self.pos)
+        self.pos+=struct.calcsize(fmt)
+        return values
+
+    def readCString(self):
+        #Read a null-terminated string without the null.
+        end=self.handle.map.find(b"\x00",self.pos) if self.handle.map else -1
+        if end==-1: raise Exception("Unterminated string at 0x%08x in %s" % (self.pos,self.name))
+        data=self.view[self.pos:end].tobytes()
+        self.pos=end+1
+        return data
+
+    def seek(self,offset,whence=0):
+        if whence==0: self.pos=offset
+        elif whence==1: self.pos+=offset
+        else: self.pos=len(self.view)+offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.handle:
+            self.view=None
+            pool.release(self.handle)
+            self.handle=None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def openFile(path):
+    if useMmap:
+        return MappedReader(path)
+    return io.BufferedReader(FileReader(path))
+
+def readAhead(path,offset,size):
+    #Get a range of an archive into the OS cache with one big sequential read so the payloads in it can be read from memory.
+    handle=pool.acquire(path)
+    try:
+        if hasattr(os,"posix_fadvise"):
+            os.posix_fadvise(handle.fd,offset,size,os.POSIX_FADV_WILLNEED)
+        else:
+            end=min(offset+size,handle.size)
+            while offset<end:
+                offset+=len(handle.readAt(offset,min(end-offset,0x100000)))
+    finally:
+        pool.release(handle)
+
+def unpackFrom(f,fmt):
+    #Unpack values at the current position, straight from the map if the file is mapped.
+    if isinstance(f,MappedReader):
+        return f.unpackFrom(fmt)
+    return struct.unpack(fmt,f.read(struct.calcsize(fmt)))
@@ -0,0 +1,373 @@
+#Micro-benchmarks for the dumper internals, run against real files from a game installation.
+#Usage: benchmark.py [name ...], runs all benchmarks if no names are given.
+import cas
+import codec
+import dbo
+import payload
+import os
+import io
+import sys
+import time
+import random
+import tracemalloc
+from struct import pack,unpack
+
+#Adjust paths here.
+#cas.cat to take sample blocks from, use the cat reader matching the game (see dumper).
+catPath    = r"D:\Games\OriginGames\Need for Speed(TM) Rivals\Data\cas.cat"
+readCat    = cas.readCat1
+sampleSize = 64*1024*1024 #compressed bytes
+
+#Folder with TOC files to decode, all TOCs in it and its subfolders are used.
+tocDir     = r"D:\Games\OriginGames\Need for Speed(TM) Rivals\Data\Win32"
+
+##############################################################
+##############################################################
+
+def loadSampleBlocks():
+    #Collect (dictFlag, uncompressedSize, comType, srcBuf) of the first blocks listed in the cat.
+    print("Reading sample blocks from %s..." % catPath)
+    readCat(catPath)
+    blocks=list()
+    total=0
+    for catEntry in cas.catDict.values():
+        f=open(catEntry.path,"rb")
+        f.seek(catEntry.offset)
+        try:
+            while f.tell()<catEntry.offset+catEntry.size:
+                block=payload.readBlock(f)
+                blocks.append(block)
+                total+=len(block[3])
+        except Exception:
+            pass #delta payloads in patched cats are not made of plain blocks
+        f.close()
+        if total>=sampleSize: break
+
+    return blocks
+
+def measure(name,func,blocks):
+    start=time.perf_counter()
+    size=func(blocks)
+    elapsed=time.perf_counter()-start
+    print("  %-40s %8.1f MB/s" % (name,size/elapsed/1024/1024 if elapsed else 0))
+
+def decodeZstdPerBlockCtx(blocks):
+    #Old path: create and free a Zstd context for every block.
+    backend=codec.getBackend(0x0f)
+    size=0
+    ctx=payload.DecompressionContext()
+    for dictFlag, uncompressedSize, comType, srcBuf in blocks:
+        state=backend.newState()
+        backend.decompress(srcBuf,uncompressedSize,ctx.getDstBuf(uncompressedSize),dictFlag,state)
+        backend.freeState(state)
+        size+=uncompressedSize
+    return size
+
+def decodeWithContext(blocks):
+    size=0
+    with payload.DecompressionContext() as ctx:
+        for dictFlag, uncompressedSize, comType, srcBuf in blocks:
+            payload.decodeBlock(dictFlag,uncompressedSize,comType,srcBuf,ctx)
+            size+=uncompressedSize
+    return size
+
+def benchZstdContext(blocks):
+    print("Zstd dictionary blocks, context per block vs reused context:")
+    dictBlocks=[block for block in blocks if block[2]==0x0f and block[0]]
+    if not dictBlocks:
+        print("  No dictionary compressed Zstd blocks in the sample.")
+        return
+
+    measure("context per block",decodeZstdPerBlockCtx,dictBlocks)
+    measure("reused context",decodeWithContext,dictBlocks)
+
+def benchCodecs(blocks):
+    print("Decompression speed of every available backend:")
+    for comType, loaded in codec.backends.items():
+        typeBlocks=[block for block in blocks if block[2]==comType]
+        if not typeBlocks: continue
+
+        for backend in loaded:
+            def decode(blocks):
+                size=0
+                with payload.DecompressionContext() as ctx:
+                    state=ctx.getState(backend)
+                    for dictFlag, uncompressedSize, comType, srcBuf in blocks:
+                        backend.decompress(srcBuf,uncompressedSize,ctx.getDstBuf(uncompressedSize),dictFlag,state)
+                        size+=uncompressedSize
+                return size
+
+            measure("%s, %s" % (codec.comTypeNames[comType],backend.name),decode,typeBlocks)
+
+def packBlock(data):
+    #Uncompressed block, so only the patching itself is measured.
+    return pack(">II",len(data),0x00700000|len(data))+data
+
+def makePatchSample(numBlocks=384,blockSize=0x8000):
+    #Synthetic base payload and a delta using every instruction type: plain base blocks (0), many tiny fixes (2),
+    #larger fixes with delta blocks (1) and whole delta blocks (3). Returns (base, delta, originalSize).
+    rand=random.Random(0)
+    base=bytearray()
+    delta=bytearray()
+    originalSize=0
+    for i in range(numBlocks):
+        base+=packBlock(rand.randbytes(blockSize))
+        kind=i%4
+        if kind==0:
+            delta+=pack(">I",0x00000001)
+            originalSize+=blockSize
+        elif kind==1:
+            fixes=bytearray()
+            pos=0
+            size=blockSize
+            for j in range(256):
+                baseRead=pos+rand.randint(0,100)
+                baseSkip, addCount = rand.randint(0,8), rand.randint(0,8)
+                fixes+=pack(">HBB",baseRead,baseSkip,addCount)+rand.randbytes(addCount)
+                pos=baseRead+baseSkip
+                size+=addCount-baseSkip
+            delta+=pack(">IH",0x20000000|len(fixes),size-1)+fixes
+            originalSize+=size
+        elif kind==2:
+            delta+=pack(">I",0x10000000|8)
+            pos=0
+            size=blockSize
+            for j in range(8):
+                baseRead=pos+rand.randint(0,2000)
+                baseSkip=rand.randint(0,512)
+                delta+=pack(">HH",baseRead,baseSkip)+packBlock(rand.randbytes(512))
+                pos=baseRead+baseSkip
+                size+=512-baseSkip
+            originalSize+=size
+        else:
+            delta+=pack(">I",0x40000001)+pack(">I",0x30000001)+packBlock(rand.randbytes(blockSize))
+            originalSize+=blockSize
+
+    return bytes(base), bytes(delta), originalSize
+
+def patchPayloadBytesIO(base,delta,deltaEnd,originalSize,f2):
+    #Old path: every fixed base block goes through a new BytesIO and each piece is written on its own.
+    while delta.tell()!=deltaEnd:
+        instructionType, instructionSize = payload.split1v7(unpack(">I",delta.read(4))[0])
+        if instructionType==0:
+            for i in range(instructionSize):
+                payload.decompressBlock(base,f2)
+        elif instructionType==2:
+            blockSize=unpack(">H",delta.read(2))[0]+1
+            deltaBlockEnd=delta.tell()+instructionSize
+            baseBlock=io.BytesIO()
+            baseBlockSize=payload.decompressBlock(base,baseBlock)
+            baseBlock.seek(0)
+            while delta.tell()!=deltaBlockEnd:
+                baseRead,baseSkip,addCount=unpack(">HBB",delta.read(4))
+                f2.write(baseBlock.read(baseRead-baseBlock.tell()))
+                baseBlock.seek(baseSkip,1)
+                f2.write(delta.read(addCount))
+            f2.write(baseBlock.read(baseBlockSize-baseBlock.tell()))
+        elif instructionType==1:
+            baseBlock=io.BytesIO()
+            baseBlockSize=payload.decompressBlock(base,baseBlock)
+            baseBlock.seek(0)
+            for i in range(instructionSize):
+                baseRead,baseSkip=unpack(">HH",delta.read(4))
+                f2.write(baseBlock.read(baseRead-baseBlock.tell()))
+                baseBlock.seek(baseSkip,1)
+                payload.decompressBlock(delta,f2)
+            f2.write(baseBlock.read(baseBlockSize-baseBlock.tell()))
+        elif instructionType==3:
+            for i in range(instructionSize):
+                payload.decompressBlock(delta,f2)
+        elif instructionType==4:
+            for i in range(instructionSize):
+                dictFlag, uncompressedSize, comType, typeFlag, compressedSize = payload.readBlockHeader(base)
+                base.seek(compressedSize,1)
+
+def benchPatch(blocks):
+    print("Delta patching of a synthetic payload, BytesIO vs patch buffer:")
+    base, delta, originalSize = makePatchSample()
+    outputs=list()
+    for name, patch in (("BytesIO per block",patchPayloadBytesIO),("patch buffer",payload.patchPayload)):
+        def run(blocks):
+            f2=io.BytesIO()
+            for i in range(10):
+                f2.seek(0)
+                patch(io.BytesIO(base),io.BytesIO(delta),len(delta),originalSize,f2)
+            outputs.append(f2.getvalue())
+            return originalSize*10
+        measure(name,run,None)
+
+    if outputs[0]!=outputs[1]: print("  Outputs differ!")
+
+class DictCatEntry:
+    #Old cat entry, one object with its own path string for every sha1 in a dict.
+    def __init__(self,offset,size,path):
+        self.offset=offset
+        self.size=size
+        self.path=os.path.join(os.path.dirname(path),os.path.basename(path))
+
+def benchCatIndex(blocks):
+    print("Cat index, dict of entry objects vs compact index:")
+    cas.catDict=cas.CatIndex()
+    readCat(catPath)
+    entries=[(sha1, entry.offset, entry.size, entry.path) for sha1, entry in cas.catDict.items()]
+    rand=random.Random(0)
+    present=[rand.choice(entries)[0] for i in range(200000)]
+    missing=[rand.randbytes(20) for i in range(len(present))]
+    print("  %d entries" % len(entries))
+
+    def buildDict():
+        return {sha1: DictCatEntry(offset,size,path) for sha1, offset, size, path in entries}
+
+    def buildIndex():
+        index=cas.CatIndex()
+        for sha1, offset, size, path in entries:
+            index.add(sha1,offset,size,path)
+        index.finish()
+        return index
+
+    for name, build in (("dict",buildDict),("compact index",buildIndex)):
+        tracemalloc.start()
+        index=build()
+        size=tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del index
+
+        start=time.perf_counter() #tracing slows everything down, build again for the time
+        index=build()
+        elapsed=time.perf_counter()-start
+
+        start=time.perf_counter()
+        for sha1 in present:
+            if sha1 in index: index[sha1].offset
+        for sha1 in missing:
+            sha1 in index
+        lookups=(time.perf_counter()-start)/(len(present)+len(missing))
+        print("  %-40s %8.1f MB, built in %.2f s, %.2f us per lookup" % (name,size/1024/1024,elapsed,lookups*1000000))
+        del index
+
+def xorLoop(encryptedData,key):
+    #Old unXor: one byte at a time.
+    size=len(encryptedData)
+    data=bytearray(size)
+    for i in range(size):
+        data[i]=key[i%257]^encryptedData[i]
+    return data
+
+def xorLoopMEA(encryptedData):
+    #Old unXorMEA: one byte at a time with the rolling key.
+    dataLen=len(encryptedData)
+    data=bytearray(dataLen)
+    key=encryptedData[0]
+    for i in range(dataLen):
+        data[i]=encryptedData[i]^key
+        key=((encryptedData[0]^encryptedData[i])-(i%256))&0xFF
+    return data
+
+def benchUnXor(blocks):
+    print("Decryption of 8 MB of synthetic data, byte loop vs big integer XOR:")
+    rand=random.Random(0)
+    encryptedData=rand.randbytes(8*1024*1024)
+    key=list(rand.randbytes(257))
+    signature=b"@e!adnXd$^!rfOsrDyIrI!xVgHeA!6Vc"
+    meaFile=encryptedData+pack("<I",36)+signature
+    outputs=list()
+
+    def run(func):
+        def runFunc(blocks):
+            outputs.append(bytes(func()))
+            return len(encryptedData)
+        return runFunc
+
+    measure("repeating key, byte loop",run(lambda: xorLoop(encryptedData,key)),None)
+    measure("repeating key, big integer",run(lambda: dbo.xorData(encryptedData,key)),None)
+    measure("MEA rolling key, byte loop",run(lambda: xorLoopMEA(encryptedData)),None)
+    measure("MEA rolling key, translate + big integer",run(lambda: dbo.unXorMEA(io.BytesIO(meaFile)).getvalue()),None)
+    if outputs[0]!=outputs[1] or outputs[2]!=outputs[3]: print("  Outputs differ!")
+
+def countNodes(obj):
+    #Number of nodes in a DbObject tree.
+    if obj.typ==dbo.DbObjectType.Object: return 1+sum(countNodes(child) for child in obj.elems.values())
+    if obj.typ==dbo.DbObjectType.Array: return 1+sum(countNodes(child) for child in obj.content)
+    return 1
+
+def plainDbObject(obj):
+    #Turn a DbObject tree into the values decodeDbObject returns, to compare the two.
+    if obj.typ==dbo.DbObjectType.Object: return {name: plainDbObject(child) for name, child in obj.elems.items()}
+    if obj.typ==dbo.DbObjectType.Array: return [plainDbObject(child) for child in obj.content]
+    return getattr(obj,"content",None)
+
+def benchDbObject(blocks):
+    print("TOC decoding, DbObject vs decodeDbObject:")
+    tocs=list()
+    for dir, folders, files in os.walk(tocDir):
+        for fname in files:
+            if fname.endswith(".toc"):
+                tocs.append(dbo.unXor(os.path.join(dir,fname)).getvalue())
+    numNodes=sum(countNodes(dbo.DbObject(io.BytesIO(data))) for data in tocs)
+    print("  %d TOCs, %.1f MB, %d nodes" % (len(tocs),sum(len(data) for data in tocs)/1024/1024,numNodes))
+
+    for name, decode in (("DbObject",lambda data: dbo.DbObject(io.BytesIO(data))),("decodeDbObject",dbo.decodeDbObject)):
+        start=time.perf_counter()
+        for data in tocs:
+            decode(data) #not kept, the garbage collector would slow down the next decoder
+        elapsed=time.perf_counter()-start
+        print("  %-40s %8.0f nodes/s" % (name,numNodes/elapsed if elapsed else 0))
+
+    for data in tocs:
+        if plainDbObject(dbo.DbObject(io.BytesIO(data)))!=dbo.decodeDbObject(data):
+            print("  Outputs differ!")
+            break
+
+def readBundleList(toc):
+    #What the dumper reads from a TOC before extracting anything.
+    return [(entry.get("id"),entry.get("offset"),entry.get("delta"),entry.get("base")) for entry in toc.get("bundles",list())]
+
+def benchDbView(blocks):
+    print("TOC bundle lists, decodeDbObject vs lazy view:")
+    tocs=list()
+    for dir, folders, files in os.walk(tocDir):
+        for fname in files:
+            if fname.endswith(".toc"):
+                tocs.append(dbo.unXor(os.path.join(dir,fname)).getvalue())
+    print("  %d TOCs, %.1f MB" % (len(tocs),sum(len(data) for data in tocs)/1024/1024))
+
+    outputs=list()
+    for name, decode in (("decodeDbObject",dbo.decodeDbObject),("viewDbObject",dbo.viewDbObject)):
+        tracemalloc.start()
+        values=[decode(data) for data in tocs]
+        bundleLists=[readBundleList(toc) for toc in values]
+        size=tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del values, bundleLists
+
+        start=time.perf_counter() #tracing slows everything down, run again for the time
+        outputs.append([readBundleList(decode(data)) for data in tocs])
+        elapsed=time.perf_counter()-start
+        print("  %-40s %8.1f MB, %.2f s" % (name,size/1024/1024,elapsed))
+
+    if outputs[0]!=outputs[1]: print("  Outputs differ!")
+
+#Benchmarks that take their blocks from the cat, the others read what they need themselves or make up their own data.
+benchmarks={
+    "zstd"     : benchZstdContext,
+    "codecs"   : benchCodecs,
+    "patch"    : benchPatch,
+    "catindex" : benchCatIndex,
+    "unxor"    : benchUnXor,
+    "dbo"      : benchDbObject,
+    "dbview"   : benchDbView,
+}
+sampleBenchmarks={"zstd","codecs"}
+
+if __name__=="__main__":
+    names=sys.argv[1:] or list(benchmarks)
+    payload.zstdInit()
+    for line in codec.describe():
+        print(line)
+    blocks=None
+    if sampleBenchmarks.intersection(names):
+        blocks=loadSampleBlocks()
+        print("%d blocks, %.1f MB compressed" % (len(blocks),sum(len(block[3]) for block in blocks)/1024/1024))
+    for name in names:
+        benchmarks[name](blocks)
+    payload.zstdCleanup()
@@ -1,61 +1,250 @@
-#Take a dict and fill it using a cat file: sha1 vs (offset, size, cas path)
+#Fill the cat index with the entries of a cat file: sha1 vs (offset, size, cas path)
 #Cat files are always little endian.
 import dbo
+import metacache
 import os
+import sys
+import array
+import bisect
+import heapq
+import threading
+import struct
+from operator import itemgetter
 from struct import pack,unpack
 
-catDict=dict()
-
 class CatEntry:
-    def __init__(self,f,casDirectory,version):
-        if version<3:
-            self.offset,self.size,casNum=unpack("<III",f.read(12))
-        else:
-            self.offset,self.size,unk,casNum=unpack("<IIII",f.read(16))
+    __slots__=("offset","size","path")
+    def __init__(self,offset,size,path):
+        self.offset=offset
+        self.size=size
+        self.path=path
 
-        self.path=os.path.join(casDirectory,"cas_%02d.cas" % casNum)
+class CatIndex:
+    """Compact replacement for a dict of sha1 -> CatEntry, modern games have millions of cat entries.
 
-def readCat1(catPath):
+    Sha1s are kept sorted in one bytearray with offsets, sizes and path numbers in parallel arrays, each path is stored once.
+    Lookups only search the range of sha1s with the same first two bytes.
+    Supports in, [], []= and get() like a dict, the CatEntry objects are created on lookup.
+
+    New entries are appended as runs, each sorted on its own, and merged on the next lookup. A later entry replaces an earlier one
+    with the same sha1 (patched cats are read after the base cats)."""
+    def __init__(self):
+        self.sha1s=bytearray()
+        self.offsets=array.array("Q")
+        self.sizes=array.array("I")
+        self.pathNums=array.array("I")
+        self.paths=list()
+        self.pathNumbers=dict() #path -> index in paths
+        self.numSorted=0 #entries after this are new and not merged yet
+        self.runs=list() #(start, isSorted) of the runs of new entries
+        self.buckets=array.array("I",bytes(4*0x10001)) #first two sha1 bytes -> index of the first such sha1
+        self.lock=threading.Lock()
+
+    def addPath(self,path):
+        #Return the number of a path, entries refer to their path by number.
+        pathNum=self.pathNumbers.get(path)
+        if pathNum is None:
+            pathNum=self.pathNumbers[path]=len(self.paths)
+            self.paths.append(path)
+        return pathNum
+
+    def add(self,sha1,offset,size,path):
+        if not self.runs or self.runs[-1][1]: self.runs.append((len(self.sizes),False))
+        self.sha1s+=sha1
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.pathNums.append(self.addPath(path))
+
+    def extend(self,sha1s,offsets,sizes,pathNums,isSorted=False):
+        #Add many entries at once, sha1s are concatenated and pathNums come from addPath.
+        #isSorted means the sha1s are sorted already and unique, so the run doesn't have to be sorted again.
+        if not sizes: return
+        self.runs.append((len(self.sizes),isSorted))
+        self.sha1s+=sha1s
+        self.offsets.extend(offsets)
+        self.sizes.extend(sizes)
+        self.pathNums.extend(pathNums)
+
+    def run(self,start,end):
+        #(sha1, index) of the entries in a range.
+        return zip(map(itemgetter(0),struct.iter_unpack("20s",self.sha1s[20*start:20*end])),range(start,end))
+
+    def finish(self):
+        #Sort the new runs and merge them with the sorted entries, dropping the entries they replace.
+        if self.numSorted==len(self.sizes): return
+        with self.lock:
+            if self.numSorted==len(self.sizes): return
+            runs=[(0,True)]+self.runs
+            bounds=[start for start, isSorted in runs[1:]]+[len(self.sizes)]
+            merged=list()
+            for (start, isSorted), end in zip(runs,bounds):
+                if start==end: continue
+                merged.append(self.run(start,end) if isSorted else sorted(self.run(start,end)))
+
+            if len(merged)>1 or not runs[-1][1]:
+                #Equal sha1s come out in the order they were added as the index is part of the key, the last one is kept.
+                sha1s=bytearray()
+                order=array.array("I")
+                append=order.append
+                lastSha1=None
+                for sha1, i in heapq.merge(*merged):
+                    if sha1==lastSha1:
+                        order[-1]=i
+                    else:
+                        sha1s+=sha1
+                        append(i)
+                        lastSha1=sha1
+
+                self.sha1s=sha1s
+                self.offsets=array.array("Q",map(self.offsets.__getitem__,order))
+                self.sizes=array.array("I",map(self.sizes.__getitem__,order))
+                self.pathNums=array.array("I",map(self.pathNums.__getitem__,order))
+
+            #Binary search the first two bytes of every sha1 for the buckets.
+            numEntries=len(self.sizes)
+            prefixes=bytearray(2*numEntries)
+            prefixes[0::2]=self.sha1s[0::20]
+            prefixes[1::2]=self.sha1s[1::20]
+            prefixes=array.array("H",prefixes)
+            if sys.byteorder=="little": prefixes.byteswap()
+            self.buckets=array.array("I",[bisect.bisect_left(prefixes,prefix) for prefix in range(0x10000)]+[numEntries])
+            self.runs=list()
+            self.numSorted=numEntries
+
+    def find(self,sha1):
+        #Return the index of sha1 or -1.
+        if self.numSorted!=len(self.sizes): self.finish()
+        if not sha1 or len(sha1)!=20: return -1
+
+        #Searching the few sha1s with the same first two bytes in one go is faster than a binary search in Python.
+        prefix=sha1[0]<<8|sha1[1]
+        end=20*self.buckets[prefix+1]
+        pos=self.sha1s.find(sha1,20*self.buckets[prefix],end)
+        while pos!=-1 and pos%20: #matched across two sha1s
+            pos=self.sha1s.find(sha1,pos+1,end)
+        if pos==-1: return -1
+        return pos//20
+
+    def entry(self,i):
+        return CatEntry(self.offsets[i],self.sizes[i],self.paths[self.pathNums[i]])
+
+    def __contains__(self,sha1):
+        return self.find(sha1)!=-1
+
+    def __getitem__(self,sha1):
+        i=self.find(sha1)
+        if i==-1: raise KeyError(sha1)
+        return self.entry(i)
+
+    def get(self,sha1,default=None):
+        i=self.find(sha1)
+        if i==-1: return default
+        return self.entry(i)
+
+    def __setitem__(self,sha1,entry):
+        self.add(sha1,entry.offset,entry.size,entry.path)
+
+    def update(self,other):
+        #Add all entries of another index, they replace the entries with the same sha1 like entries added later do.
+        other.finish()
+        pathNums=[self.addPath(path) for path in other.paths]
+        self.extend(other.sha1s,other.offsets,other.sizes,[pathNums[pathNum] for pathNum in other.pathNums],True)
+
+    def __len__(self):
+        self.finish()
+        return len(self.sizes)
+
+    def items(self):
+        self.finish()
+        for i in range(len(self.sizes)):
+            yield bytes(self.sha1s[20*i:20*i+20]), self.entry(i)
+
+    def values(self):
+        for sha1, entry in self.items():
+            yield entry
+
+    def __getstate__(self):
+        #Sent to the worker processes sorted, without the lock.
+        self.finish()
+        state=self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self,state):
+        self.runs=list()
+        self.__dict__.update(state)
+        self.lock=threading.Lock()
+
+catDict=CatIndex()
+
+def readCatEntries(cat,numEntries,casDirectory,version):
+    #Entries have a fixed size so they're all unpacked in one go, straight from the decrypted data.
+    #Reads up to the end of the cat if numEntries is None. Returns a new index with the entries.
+    fmt="<20sIII" if version<3 else "<20sIIII"
+    entrySize=struct.calcsize(fmt)
+    data=cat.getbuffer()
+    start=cat.tell()
+    if numEntries is None: numEntries=(len(data)-start)//entrySize
+    entries=list(struct.iter_unpack(fmt,data[start:start+numEntries*entrySize]))
+    data.release()
+
+    #Sort the entries while the sha1s are at hand, so the index only has to merge sorted runs. The last of equal sha1s is kept.
+    entries.sort(key=itemgetter(0))
+    entries=[entry for n, entry in enumerate(entries) if n+1==len(entries) or entries[n+1][0]!=entry[0]]
+
+    catIndex=CatIndex()
+    pathNums=dict() #cas number -> path number in the index
+    for casNum in set(entry[-1] for entry in entries):
+        pathNums[casNum]=catIndex.addPath(os.path.join(casDirectory,"cas_%02d.cas" % casNum))
+
+    catIndex.extend(b"".join([entry[0] for entry in entries]),
+                    [entry[1] for entry in entries],
+                    [entry[2] for entry in entries],
+                    [pathNums[entry[-1]] for entry in entries],True)
+    catIndex.finish()
+    return catIndex
+
+#Each cat version has a parser returning an index of its entries, the readers add them to catDict.
+#Parsed cats are kept in the metadata cache.
+def parseCat1(catPath):
     #2013, original version.
     cat=dbo.unXor(catPath)
-    cat.seek(0,2) #get eof
-    catSize=cat.tell()
     cat.seek(16) #skip nyan
     casDirectory=os.path.dirname(catPath)
+    return readCatEntries(cat,None,casDirectory,1)
 
-    while cat.tell()!=catSize:
-        sha1=cat.read(20)
-        catDict[sha1]=CatEntry(cat,casDirectory,1)
-
-def readCat2(catPath):
+def parseCat2(catPath):
     #2015 (SWBF Beta), added the number of entries in the header and a new section with unknown data (usually empty).
     cat=dbo.unXor(catPath)
     cat.seek(16) #skip nyan
     numEntries, unk = unpack("<II",cat.read(8))
     casDirectory=os.path.dirname(catPath)
+    return readCatEntries(cat,numEntries,casDirectory,2)
 
-    for i in range(numEntries):
-        sha1=cat.read(20)
-        catDict[sha1]=CatEntry(cat,casDirectory,2)
-
-def readCat3(catPath):
+def parseCat3(catPath):
     #2015 (SWBF Final), added a a new var (always 0?) to cat entry.
     cat=dbo.unXor(catPath)
     cat.seek(16) #skip nyan
     numEntries, unk = unpack("<II",cat.read(8))
     casDirectory=os.path.dirname(catPath)
+    return readCatEntries(cat,numEntries,casDirectory,3)
 
-    for i in range(numEntries):
-        sha1=cat.read(20)
-        catDict[sha1]=CatEntry(cat,casDirectory,3)
-
-def readCat4(catPath):
+def parseCat4(catPath):
     #2017, added more unknown sections.
     cat=dbo.unXor(catPath)
     cat.seek(16) #skip nyan
     numEntries, unk, unk2, unk3 = unpack("<IIQQ",cat.read(24))
     casDirectory=os.path.dirname(catPath)
+    return readCatEntries(cat,numEntries,casDirectory,4)
+
+def readCat1(catPath):
+    catDict.update(metacache.cached("cat1",catPath,parseCat1))
 
-    for i in range(numEntries):
-        sha1=cat.read(20)
-        catDict[sha1]=CatEntry(cat,casDirectory,4)
+def readCat2(catPath):
+    catDict.update(metacache.cached("cat2",catPath,parseCat2))
+
+def readCat3(catPath):
+    catDict.update(metacache.cached("cat3",catPath,parseCat3))
+
+def readCat4(catPath):
+    catDict.update(metacache.cached("cat4",catPath,parseCat4))
@@ -0,0 +1,202 @@
+#Decompression backends for the compression types found in payload blocks.
+#Each compression type can be handled by several backends, they're probed in this order and the first one that loads is used:
+#    system shared library (liblz4.so, libzstd.so, ...), Python module (lz4, zstandard), library bundled in thirdparty directory.
+import abc
+import ctypes
+import ctypes.util
+import os
+import zlib
+
+thirdpartyDir=os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","thirdparty")
+
+comTypeNames={
+    0x00 : "None",
+    0x02 : "zlib",
+    0x09 : "LZ4",
+    0x0f : "Zstd",
+    0x15 : "Oodle",
+}
+
+def cbuf(buf):
+    #ctypes can't take memoryviews as pointers, wrap them in a ctypes array over the same memory.
+    if isinstance(buf,memoryview):
+        return (ctypes.c_char*len(buf)).from_buffer(buf)
+    return buf
+
+def systemLibrary(name):
+    path=ctypes.util.find_library(name)
+    if not path: raise OSError("System library %s not found." % name)
+    return path
+
+def bundledLibrary(name):
+    return os.path.join(thirdpartyDir,name)
+
+class Backend(abc.ABC):
+    """Base class for backends, the constructor raises if the backend is not available.
+
+    decompress() may write into dstBuf (ctypes array of at least uncompressedSize bytes) and return it or return the data some other way.
+    State is created once per thread, see payload.DecompressionContext."""
+    name=""
+
+    def newState(self):
+        return None
+
+    def freeState(self,state):
+        pass
+
+    def loadDict(self,data):
+        pass
+
+    def freeDict(self):
+        pass
+
+    @abc.abstractmethod
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        pass
+
+class RawBackend(Backend):
+    name="builtin"
+
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        #No compression, the block is stored as it is.
+        return srcBuf
+
+class ZlibBackend(Backend):
+    name="Python zlib"
+
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        return zlib.decompress(srcBuf)
+
+class NativeLz4Backend(Backend):
+    def __init__(self,path,kind):
+        self.lib=ctypes.cdll.LoadLibrary(path)
+        self.lib.LZ4_decompress_safe_partial.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int32,ctypes.c_int32,ctypes.c_int32]
+        self.name="%s (%s)" % (kind,path)
+
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        self.lib.LZ4_decompress_safe_partial(cbuf(srcBuf),dstBuf,len(srcBuf),uncompressedSize,uncompressedSize)
+        return dstBuf
+
+class PythonLz4Backend(Backend):
+    name="Python lz4"
+
+    def __init__(self):
+        import lz4.block
+        self.block=lz4.block
+
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        return self.block.decompress(srcBuf,uncompressed_size=uncompressedSize)
+
+class NativeZstdBackend(Backend):
+    def __init__(self,path,kind):
+        self.lib=ctypes.cdll.LoadLibrary(path)
+        self.lib.ZSTD_createDDict.restype=ctypes.c_void_p
+        self.lib.ZSTD_createDDict.argtypes=[ctypes.c_void_p,ctypes.c_size_t]
+        self.lib.ZSTD_freeDDict.argtypes=[ctypes.c_void_p]
+        self.lib.ZSTD_createDCtx.restype=ctypes.c_void_p
+        self.lib.ZSTD_decompress_usingDDict.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p]
+        self.lib.ZSTD_freeDCtx.argtypes=[ctypes.c_void_p]
+        self.lib.ZSTD_decompress.argtypes=[ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p,ctypes.c_size_t]
+        self.name="%s (%s)" % (kind,path)
+        self.ddict=None
+
+    def newState(self):
+        return ctypes.c_void_p(self.lib.ZSTD_createDCtx())
+
+    def freeState(self,state):
+        self.lib.ZSTD_freeDCtx(state)
+
+    def loadDict(self,data):
+        self.ddict=ctypes.c_void_p(self.lib.ZSTD_createDDict(data,len(data)))
+
+    def freeDict(self):
+        if self.ddict:
+            self.lib.ZSTD_freeDDict(self.ddict)
+            self.ddict=None
+
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        if dictFlag:
+            self.lib.ZSTD_decompress_usingDDict(state,dstBuf,uncompressedSize,cbuf(srcBuf),len(srcBuf),self.ddict)
+        else:
+            self.lib.ZSTD_decompress(dstBuf,uncompressedSize,cbuf(srcBuf),len(srcBuf))
+        return dstBuf
+
+class PythonZstdBackend(Backend):
+    name="Python zstandard"
+
+    def __init__(self):
+        import zstandard
+        self.zstandard=zstandard
+        self.dict=None
+
+    def newState(self):
+        #Decompressors are not thread-safe, each thread gets its own pair.
+        plain=self.zstandard.ZstdDecompressor()
+        withDict=self.zstandard.ZstdDecompressor(dict_data=self.dict) if self.dict else None
+        return plain, withDict
+
+    def loadDict(self,data):
+        self.dict=self.zstandard.ZstdCompressionDict(data)
+
+    def freeDict(self):
+        self.dict=None
+
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        return state[1 if dictFlag else 0].decompress(srcBuf,max_output_size=uncompressedSize)
+
+class NativeOodleBackend(Backend):
+    def __init__(self,path,kind):
+        self.lib=ctypes.windll.LoadLibrary(path)
+        self.lib.OodleLZ_Decompress.argtypes=[ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p,ctypes.c_size_t,
+                                              ctypes.c_int,ctypes.c_int,ctypes.c_int,
+                                              ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,
+                                              ctypes.c_int]
+        self.name="%s (%s)" % (kind,path)
+
+    def decompress(self,srcBuf,uncompressedSize,dstBuf,dictFlag,state):
+        self.lib.OodleLZ_Decompress(cbuf(srcBuf),len(srcBuf),dstBuf,uncompressedSize,0,0,0,0,0,0,0,0,0,3)
+        return dstBuf
+
+#Candidate backends for each compression type in probing order.
+candidates={
+    0x00 : [RawBackend],
+    0x02 : [ZlibBackend],
+    0x09 : [lambda: NativeLz4Backend(systemLibrary("lz4"),"system library"),
+            PythonLz4Backend,
+            lambda: NativeLz4Backend(bundledLibrary("liblz4"),"bundled library")],
+    0x0f : [lambda: NativeZstdBackend(systemLibrary("zstd"),"system library"),
+            PythonZstdBackend,
+            lambda: NativeZstdBackend(bundledLibrary("libzstd"),"bundled library")],
+    0x15 : [lambda: NativeOodleBackend(bundledLibrary("oo2core_4_win64"),"bundled library")],
+}
+
+missingMessages={
+    0x15 : "You need oo2core_4_win64.dll to decompress Oodle v4.",
+}
+
+#All backends that loaded for each compression type, the first one is active.
+backends=dict()
+
+def probe():
+    for comType, factories in candidates.items():
+        backends[comType]=list()
+        for factory in factories:
+            try:
+                backends[comType].append(factory())
+            except (OSError,ImportError,AttributeError):
+                pass
+
+def getBackend(comType):
+    if comType not in backends:
+        raise Exception("Unknown compression type 0x%02x" % comType)
+    if not backends[comType]:
+        raise Exception(missingMessages.get(comType,"No backend available to decompress %s." % comTypeNames[comType]))
+    return backends[comType][0]
+
+def describe():
+    lines=list()
+    for comType, loaded in backends.items():
+        lines.append("%-5s : %s" % (comTypeNames.get(comType,"0x%02x" % comType),loaded[0].name if loaded else "not available"))
+    return lines
+
+probe()
@@ -2,9 +2,14 @@
 import dbo
 import cas
 import payload
+import archive
 import ebx
+import metacache
 import io
 import os
+import multiprocessing
+import itertools
+import struct
 from struct import pack,unpack
 import res
 
@@ -21,14 +26,18 @@ def readStringBuffer(f,len):
     f.seek(end)
     return result.decode()
 
-#Mutated cas.cat format.
-class DalEntry:
-    def __init__(self,f,offset,dasPath):
-        self.offset=offset
-        self.size=unpack("<I",f.read(4))[0]
-        self.path=dasPath
-
 def readDal(dalPath):
+    #The entries are in the das files, the cached index is only used if none of them has changed either.
+    dalIndex=metacache.get("dal",dalPath)
+    if dalIndex is None:
+        dalIndex, dasPaths = parseDal(dalPath)
+        metacache.put("dal",dalPath,dalIndex,dasPaths)
+    cas.catDict.update(dalIndex)
+
+def parseDal(dalPath):
+    #Return an index of the entries and the das files they were read from.
+    dalIndex=cas.CatIndex()
+    dasPaths=list()
     dasDirectory=os.path.dirname(dalPath)
     f=open(dalPath,"rb")
     numDas=unpack("<B",f.read(1))[0]
@@ -37,18 +46,23 @@ def readDal(dalPath):
         name=readStringBuffer(f,64)
         numEntries=unpack("<I",f.read(4))[0]
         dasPath=os.path.join(dasDirectory,"das_%s.das" % name)
+        dasPaths.append(dasPath)
 
+        #Mutated cas.cat format: the das starts with sha1 and size of every entry, the payloads follow in the same order.
         f2=open(dasPath,"rb")
-        dataOffset=numEntries*24
-        for j in range(numEntries):
-            sha1=f2.read(20)
-            dalEntry=DalEntry(f2,dataOffset,dasPath)
-            cas.catDict[sha1]=dalEntry
-            dataOffset+=dalEntry.size
-
+        entries=list(struct.iter_unpack("<20sI",f2.read(numEntries*24)))
         f2.close()
 
+        sizes=[entry[1] for entry in entries]
+        pathNum=dalIndex.addPath(dasPath)
+        dalIndex.extend(b"".join([entry[0] for entry in entries]),
+                        list(itertools.accumulate(sizes,initial=numEntries*24))[:-1], #offsets
+                        sizes,
+                        [pathNum]*len(entries))
+
     f.close()
+    dalIndex.finish()
+    return dalIndex, dasPaths
 
 def prepareDir(targetPath):
     if os.path.exists(targetPath): return True
@@ -61,7 +75,7 @@ def dump(tocPath,outPath):
     if not (toc.getSubObject("bundles") or toc.get("chunks")): return #there's nothing to extract (the sb might not even exist)
 
     sbPath=tocPath[:-3]+"sb"
-    sb=open(sbPath,"rb")
+    sb=archive.openFile(sbPath)
 
     chunkPathToc=os.path.join(outPath,"chunks")
     bundlePath=os.path.join(outPath,"bundles")
@@ -75,8 +89,8 @@ def dump(tocPath,outPath):
     offsets=bundles.get("offsets")
 
     for offset in offsets:
-        sb.seek(offset.content)
-        bundle=dbo.DbObject(sb)
+        sb.seek(offset)
+        bundle=dbo.readDbObject(sb)
 
         for entry in bundle.get("ebx",list()): #name sha1 size originalSize
             path=os.path.join(ebxPath,entry.get("name")+".ebx")
@@ -101,58 +115,69 @@ def dump(tocPath,outPath):
     sb.close()
 
 #FrontEnd DAS files, this is its own archive format completely separate from the rest of the filesystem.
-def extractDas(dasPath,outPath):
-    f=open(dasPath,"rb")
-    feFolder=os.path.join(outPath,"fe")
+#FE files are decrypted and written in chunks of this size so big files don't have to fit in memory.
+chunkSize=0x100000
+
+def copyDecrypted(f,f2,size,key):
+    #Copy size bytes from f to f2 and XOR them with the key (None to copy them as they are).
+    #Every file starts at the beginning of the key, the key phase carries over from one chunk to the next.
+    if key: keyStream=bytes(key)*(chunkSize//len(key)+2)
+    phase=0
+    while size:
+        data=f.read(min(size,chunkSize))
+        if not data: break #truncated archive
+        size-=len(data)
+        if key:
+            stream=keyStream[phase:phase+len(data)]
+            data=(int.from_bytes(data,"little")^int.from_bytes(stream,"little")).to_bytes(len(data),"little")
+            phase=(phase+len(data))%len(key)
+        f2.write(data)
 
-    #Decrypt DAS header
+def readDasHeader(f):
+    #Return the encryption mode, the key and (name, size) of every entry, f is left at the first entry.
     magic=f.read(4)
+    key=None
     if magic in (b"\x00\xD1\xCE\x00",b"\x00\xD1\xCE\x01"): #the file is XOR encrypted and has a signature
         f.seek(296) #skip the signature
-        key=[f.read(1)[0]^0x7b for i in range(260)] #bytes 257 258 259 are not used
+        key=[f.read(1)[0]^0x7b for i in range(260)][:257] #bytes 257 258 259 are not used
         numEntries=unpack("<I",f.read(4))[0]
-        size=numEntries*132
-        encryptedData=f.read(size)
-        data=bytearray(size) #initalize the buffer
-        for i in range(size):
-            data[i]=key[i%257]^encryptedData[i]
+        data=dbo.xorData(f.read(numEntries*132),key)
     elif magic in (b"\x00\xD1\xCE\x03"): #the file has empty signature and empty key, it's not encrypted
         f.seek(556) #skip signature + skip empty key
         numEntries=unpack("<I",f.read(4))[0]
-        size=numEntries*132
-        encryptedData=f.read(size)
-        data=bytearray(size) #initalize the buffer
-        for i in range(size):
-            data[i]=encryptedData[i]^0x7b
+        data=dbo.xorData(f.read(numEntries*132),[0x7b])
     else:
         raise Exception("Unknown DAS header magic.")
 
-    encryptionMode=magic[3]
     header=io.BytesIO(data)
-
+    entries=list()
     for i in range(numEntries):
         name=readStringBuffer(header,128)
         size=unpack("<I",header.read(4))[0]
+        entries.append((name,size))
+    return magic[3], key, entries
+
+def extractDas(dasPath,outPath,skipNames=frozenset()):
+    #Files in skipNames are written by a later archive.
+    f=open(dasPath,"rb")
+    feFolder=os.path.join(outPath,"fe")
+    encryptionMode, key, entries = readDasHeader(f)
 
-        if encryptionMode==0:
-            encryptedData=f.read(size)
-            data=bytearray(size)
-            for i in range(size):
-                data[i]=key[i%257]^encryptedData[i]
-        elif encryptionMode==1:
+    for name, size in entries:
+        if encryptionMode==1:
             f.seek(292,1) #skip the signature
-            encryptedData=f.read(size)
-            data=bytearray(size)
-            for i in range(size):
-                data[i]=key[i%257]^encryptedData[i]
-        else:
-            data=f.read(size)
+
+        if name in skipNames:
+            f.seek(size,1)
+            continue
 
         targetFile=os.path.normpath(os.path.join(feFolder,name))
         prepareDir(targetFile)
-        f2=open(targetFile,"wb")
-        f2.write(data)
+        tmpPath=payload.tempPath(targetFile)
+        f2=open(tmpPath,"wb")
+        copyDecrypted(f,f2,size,key if encryptionMode in (0,1) else None)
         f2.close()
+        payload.commitFile(tmpPath,targetFile,True)
 
     f.close()
 
@@ -165,10 +190,38 @@ def dumpRoot(dataDir,outPath):
                 print(localPath)
                 dump(fname,outPath)
 
-def dumpFE(dataDir,outPath):
-    for fname in os.listdir(dataDir):
+def dumpFE(dataDir,outPath,numProcesses=1):
+    jobs=list()
+    for fname in sorted(os.listdir(dataDir)):
         if fname[:6]=="das_fe":
             fname=os.path.join(dataDir,fname)
             localPath=os.path.relpath(fname,dataDir)
+            jobs.append((localPath,fname,outPath,set()))
+
+    #A file in several archives ends up with the data of the last one, like when they're extracted one after another.
+    #Only that archive writes it so the result doesn't depend on which process finishes last.
+    owners=dict() #name -> job
+    for job in jobs:
+        f=open(job[1],"rb")
+        for name, size in readDasHeader(f)[2]:
+            if name in owners and owners[name] is not job: owners[name][3].add(name)
+            owners[name]=job
+        f.close()
+
+    if numProcesses<=1:
+        for localPath, fname, outPath, skipNames in jobs:
             print(localPath)
-            extractDas(fname,outPath)
+            extractDas(fname,outPath,skipNames)
+        return
+
+    #Archives don't depend on each other, extract several at once.
+    pool=multiprocessing.Pool(min(numProcesses,len(jobs)) or 1)
+    for localPath in pool.imap(extractDasJob,jobs):
+        print(localPath)
+    pool.close()
+    pool.join()
+
+def extractDasJob(job):
+    localPath, fname, outPath, skipNames = job
+    extractDas(fname,outPath,skipNames)
+    return localPath
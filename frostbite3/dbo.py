@@ -2,8 +2,17 @@
 #Each entry can hold a value of a specic type or more entries embedded into it.
 #Values are always little endian.
 from struct import unpack
+import struct
 import io
 from collections import OrderedDict
+import archive
+import metacache
+
+def xorData(encryptedData,key):
+    #XOR the data with a repeating key. Done on big integers in one go, a loop over the bytes takes seconds on big cats.
+    size=len(encryptedData)
+    keyStream=(bytes(key)*(size//len(key)+1))[:size]
+    return bytearray((int.from_bytes(encryptedData,"little")^int.from_bytes(keyStream,"little")).to_bytes(size,"little"))
 
 def unXor(path):
     """Take a filename (usually toc or cat), decrypt the file if necessary, close it and return the unencrypted data in a memory stream.
@@ -18,11 +27,7 @@ def unXor(path):
     if magic in (b"\x00\xD1\xCE\x00"): #the file is XOR encrypted and has a signature
         f.seek(296) #skip the signature
         key=[f.read(1)[0]^0x7b for i in range(260)] #bytes 257 258 259 are not used
-        encryptedData=f.read()
-        size=len(encryptedData)
-        data=bytearray(size) #initalize the buffer
-        for i in range(size):
-            data[i]=key[i%257]^encryptedData[i]
+        data=xorData(f.read(),key[:257])
     elif magic in (b"\x00\xD1\xCE\x01",b"\x00\xD1\xCE\x03"): #the file has a signature, but an empty key; it's not encrypted
         f.seek(556) #skip signature + skip empty key
         data=f.read()
@@ -47,20 +52,39 @@ def unXorMEA(f):
     headerSize=unpackLE("I",f.read(4))[0]
     f.seek(0)
     encryptedData=f.read(size-headerSize)
-    dataLen=len(encryptedData)
-    data=bytearray(dataLen)
-    key=encryptedData[0]
-    for i in range(dataLen):
-        data[i]=encryptedData[i]^key
-        key=((encryptedData[0]^encryptedData[i])-(i%256))&0xFF
-
     f.close()
+    if not encryptedData: return io.BytesIO()
+
+    #The key of byte i+1 is ((encryptedData[0]^encryptedData[i])-(i%256))&0xFF, so the key of every byte is known from the encrypted data.
+    #Bytes with the same i%256 are translated together to get all keys with 256 calls.
+    first=encryptedData[0]
+    keys=bytearray(encryptedData)
+    for residue in range(256):
+        table=bytes(((first^byte)-residue)&0xFF for byte in range(256))
+        keys[residue::256]=keys[residue::256].translate(table)
+    keys[1:]=keys[:-1]
+    keys[0]=first #key of byte 0
+
+    dataLen=len(encryptedData)
+    data=(int.from_bytes(encryptedData,"little")^int.from_bytes(keys,"little")).to_bytes(dataLen,"little")
     return io.BytesIO(data)
 
 
 
 def decode7bit(f):
     """Reads the next few bytes in a file as LEB128/7bit encoding and returns an integer"""
+    if isinstance(f,archive.MappedReader):
+        result,shift = 0,0
+        view, pos = f.view, f.pos
+        while 1:
+            byte=view[pos]
+            pos+=1
+            result|=(byte&0x7f)<<shift
+            if byte>>7==0:
+                f.pos=pos
+                return result
+            shift+=7
+
     result,shift = 0,0
     while 1:
         byte=f.read(1)[0]
@@ -69,6 +93,8 @@ def decode7bit(f):
         shift+=7
 
 def readNullTerminatedString(f):
+    if isinstance(f,archive.MappedReader): return f.readCString().decode()
+
     result=b""
     while 1:
         byte=f.read(1)
@@ -99,6 +125,12 @@ class Guid:
     def __hash__(self):
         return hash(self.val)
 
+    def fromdata(data,pos):
+        #Faster than frombytes, reads a little endian Guid at data[pos:pos+16].
+        guid=Guid.__new__(Guid)
+        guid.val=unpackGuidLE(data,pos)+unpackQBE(data,pos+8)
+        return guid
+
     def format(self):
         return "%08x-%04x-%04x-%04x-%012x" % (self.val[0],self.val[1],self.val[2],
                                              (self.val[3]>>48)&0xFFFF,self.val[3]&0x0000FFFFFFFFFFFF)
@@ -271,5 +303,283 @@ class DbObject:
         try: return self.elems[fieldName]
         except: return None
 
+#DbObject builds a tree of wrappers reading the file a byte at a time, that's slow on the millions of nodes in TOCs and bundles.
+#decodeDbObject decodes data in memory straight into plain values instead:
+#objects become a DbDict (a dict with the get/getSubObject of DbObject), arrays a list and the other types the content DbObject would have.
+unpackGuidLE=struct.Struct("<IHH").unpack_from
+unpackQBE=struct.Struct(">Q").unpack_from
+unpackI=struct.Struct("<I").unpack_from
+unpackQ=struct.Struct("<Q").unpack_from
+unpackf=struct.Struct("<f").unpack_from
+unpackd=struct.Struct("<d").unpack_from
+
+class DbDict(dict):
+    __slots__=()
+    def get(self,fieldName,defaultVal=None):
+        value=dict.get(self,fieldName)
+        if value is None: return defaultVal #missing or Null
+        return value
+
+    def getSubObject(self,fieldName):
+        return dict.get(self,fieldName)
+
+#Types which are rare enough to be read with their classes above from a stream.
+streamTypes={
+    DbObjectType.ObjectId:DbObjectId,
+    DbObjectType.Timestamp:DbTimestamp,
+    DbObjectType.RecordId:DbRecordId,
+    DbObjectType.Vector4:Vector4D,
+    DbObjectType.Matrix44:Matrix4x4,
+    DbObjectType.Timespan:DbTimespan,
+}
+
+def readVarInt(data,pos):
+    #decode7bit for data in memory, return the integer and the offset after it.
+    byte=data[pos]
+    if byte<0x80: return byte, pos+1
+    result,shift = byte&0x7f,7
+    while 1:
+        pos+=1
+        byte=data[pos]
+        result|=(byte&0x7f)<<shift
+        if byte<0x80: return result, pos+1
+        shift+=7
+
+def decodeNode(data,pos):
+    #Return name, value and end offset of the node at pos.
+    header=data[pos]
+    typ=header&0x1F
+    if header&0x80: #root entry
+        name=""
+        pos+=1
+    else:
+        end=data.index(b"\x00",pos+1)
+        name=data[pos+1:end].decode()
+        pos=end+1
+
+    if typ==DbObjectType.Object:
+        size, pos = readVarInt(data,pos)
+        end=pos+size-1 #-1 because of final nullbyte
+        value=DbDict()
+        while pos<end:
+            fieldName, value[fieldName], pos = decodeNode(data,pos)
+        if data[end]!=0: raise Exception(r"Entry does not end with \x00 byte. Position: "+str(end+1))
+        return name, value, end+1
+
+    elif typ==DbObjectType.Array:
+        size, pos = readVarInt(data,pos)
+        end=pos+size-1 #lists end on nullbyte
+        value=list()
+        while pos<end:
+            elemName, elem, pos = decodeNode(data,pos)
+            value.append(elem)
+        if data[end]!=0: raise Exception(r"Array does not end with \x00 byte. Position: "+str(end+1))
+        return name, value, end+1
+
+    elif typ==DbObjectType.String:
+        size, pos = readVarInt(data,pos)
+        return name, data[pos:pos+size-1].decode(), pos+size #size includes the trailing null
+
+    elif typ==DbObjectType.Integer:
+        return name, unpackI(data,pos)[0], pos+4
+
+    elif typ==DbObjectType.Long:
+        return name, unpackQ(data,pos)[0], pos+8
+
+    elif typ==DbObjectType.SHA1 or typ==DbObjectType.Attachment:
+        return name, data[pos:pos+20], pos+20
+
+    elif typ==DbObjectType.GUID:
+        return name, Guid.fromdata(data,pos), pos+16
+
+    elif typ==DbObjectType.Bool:
+        return name, data[pos]!=0, pos+1
+
+    elif typ==DbObjectType.VarInt:
+        val, pos = readVarInt(data,pos)
+        return name, (val>>1)^(val&1), pos
+
+    elif typ==DbObjectType.Blob:
+        size, pos = readVarInt(data,pos)
+        return name, data[pos:pos+size], pos+size
+
+    elif typ==DbObjectType.Float:
+        return name, unpackf(data,pos)[0], pos+4
+
+    elif typ==DbObjectType.Double:
+        return name, unpackd(data,pos)[0], pos+8
+
+    elif typ==DbObjectType.Null:
+        return name, None, pos
+
+    elif typ in streamTypes:
+        f=io.BytesIO(data) #shares the bytes, no copy
+        f.seek(pos)
+        value=streamTypes[typ](f)
+        return name, value, f.tell()
+
+    else:
+        raise Exception("Unhandled DB object type 0x%02x at 0x%08x." % (typ,pos))
+
+def decodeDbObject(data,pos=0):
+    """Decode the DbObject at data[pos:] (bytes or memoryview) and return its value."""
+    if not isinstance(data,bytes): data=bytes(data)
+    return decodeNode(data,pos)[1]
+
+#Most of a TOC is never looked at, e.g. only id, offset, delta and base of the bundles are needed to dump it.
+#viewDbObject returns views which only decode what is accessed. Objects and arrays have their size in front,
+#so indexing one skips whole nested objects and arrays without looking inside.
+
+#Size of the values of fixed size types, the others are skipped by their length or varint.
+fixedSizes={
+    DbObjectType.Null:0,
+    DbObjectType.ObjectId:12,
+    DbObjectType.Bool:1,
+    DbObjectType.Integer:4,
+    DbObjectType.Long:8,
+    DbObjectType.Float:4,
+    DbObjectType.Double:8,
+    DbObjectType.Timestamp:8,
+    DbObjectType.RecordId:6,
+    DbObjectType.GUID:16,
+    DbObjectType.SHA1:20,
+    DbObjectType.Matrix44:64,
+    DbObjectType.Vector4:16,
+    DbObjectType.Attachment:20,
+}
+sizedTypes={DbObjectType.Object,DbObjectType.Array,DbObjectType.String,DbObjectType.Blob}
+
+def skipNode(data,pos):
+    #Return name, type, offset of the value and end offset of the node at pos without decoding the value.
+    header=data[pos]
+    typ=header&0x1F
+    if header&0x80: #root entry
+        name=""
+        pos+=1
+    else:
+        end=data.index(b"\x00",pos+1)
+        name=data[pos+1:end].decode()
+        pos=end+1
+
+    size=fixedSizes.get(typ)
+    if size is not None: return name, typ, pos, pos+size
+    if typ in sizedTypes:
+        size, end = readVarInt(data,pos)
+        return name, typ, pos, end+size
+    if typ==DbObjectType.VarInt or typ==DbObjectType.Timespan:
+        return name, typ, pos, readVarInt(data,pos)[1]
+    raise Exception("Unhandled DB object type 0x%02x at 0x%08x." % (typ,pos))
+
+def viewNode(data,pos):
+    #Value of the node at pos, objects and arrays as views.
+    typ=data[pos]&0x1F
+    if typ==DbObjectType.Object: return DbView(data,pos)
+    if typ==DbObjectType.Array: return DbListView(data,pos)
+    return decodeNode(data,pos)[1]
+
+def contentRange(data,pos):
+    #Return the offsets of the first node in the object or array at pos and of its final nullbyte.
+    name, typ, pos, end = skipNode(data,pos)
+    pos=readVarInt(data,pos)[1]
+    if data[end-1]!=0: raise Exception(r"Entry does not end with \x00 byte. Position: "+str(end))
+    return pos, end-1
+
+class DbView:
+    """Lazy DbObject object, works like a DbDict.
+
+    The fields are decoded on first access, nested objects and arrays are skipped and become views themselves."""
+    __slots__=("data","pos","fields")
+    def __init__(self,data,pos):
+        self.data=data
+        self.pos=pos
+        self.fields=None
+
+    def getFields(self):
+        if self.fields is not None: return self.fields
+        data=self.data
+        fields=dict()
+        pos, end = contentRange(data,self.pos)
+        while pos<end:
+            typ=data[pos]&0x1F
+            if typ==DbObjectType.Object or typ==DbObjectType.Array:
+                name, typ, valuePos, nodeEnd = skipNode(data,pos)
+                fields[name]=DbView(data,pos) if typ==DbObjectType.Object else DbListView(data,pos)
+                pos=nodeEnd
+            else:
+                name, fields[name], pos = decodeNode(data,pos)
+        self.fields=fields
+        return fields
+
+    def get(self,fieldName,defaultVal=None):
+        value=self.getFields().get(fieldName)
+        if value is None: return defaultVal #missing or Null
+        return value
+
+    def getSubObject(self,fieldName):
+        return self.getFields().get(fieldName)
+
+    def __contains__(self,fieldName):
+        return fieldName in self.getFields()
+
+    def __reduce__(self):
+        #Pickled as the undecoded data, views of the same data share it.
+        return DbView, (self.data,self.pos)
+
+class DbListView:
+    """Lazy DbObject array, works like a list. The elements are indexed on first access and decoded whenever read."""
+    __slots__=("data","pos","offsets")
+    def __init__(self,data,pos):
+        self.data=data
+        self.pos=pos
+        self.offsets=None #offsets of the element nodes
+
+    def getOffsets(self):
+        if self.offsets is not None: return self.offsets
+        data=self.data
+        offsets=list()
+        pos, end = contentRange(data,self.pos)
+        while pos<end:
+            offsets.append(pos)
+            pos=skipNode(data,pos)[3]
+        self.offsets=offsets
+        return offsets
+
+    def __len__(self):
+        return len(self.getOffsets())
+
+    def __getitem__(self,i):
+        return viewNode(self.data,self.getOffsets()[i])
+
+    def __iter__(self):
+        data=self.data
+        for pos in self.getOffsets():
+            yield viewNode(data,pos)
+
+    def __reduce__(self):
+        return DbListView, (self.data,self.pos)
+
+def viewDbObject(data,pos=0):
+    """Return the DbObject at data[pos:] (bytes or memoryview), objects and arrays as lazy views."""
+    if not isinstance(data,bytes): data=bytes(data)
+    return viewNode(data,pos)
+
+def readDbObject(f,lazy=False):
+    """Read the object or array at the current position of f and return it decoded (or as a view if lazy), f is left after it.
+
+    The size of the data is known from its header so it's read in one go."""
+    pos=f.tell()
+    header=f.read(1)[0]
+    if not header&0x80: readNullTerminatedString(f)
+    if header&0x1F not in (DbObjectType.Object,DbObjectType.Array):
+        raise Exception("DB object at 0x%08x is not an object or array." % pos)
+    size=decode7bit(f)
+    end=f.tell()+size
+    f.seek(pos)
+    data=f.read(end-pos)
+    return viewDbObject(data) if lazy else decodeDbObject(data)
+
 def readToc(tocPath): #take a filename, decrypt the file and make an entry out of it
-    return DbObject(unXor(tocPath))
+    return metacache.cached("toc",tocPath,parseToc)
+
+def parseToc(tocPath):
+    return viewDbObject(unXor(tocPath).getvalue())
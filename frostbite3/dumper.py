@@ -5,11 +5,21 @@ import dbo
 import noncas
 import ebx
 import payload
+import codec
+import archive
 import cas
 import das
 import os
+import sys
 from struct import pack,unpack
 import res
+import multiprocessing
+import concurrent.futures
+import threading
+import time
+import journal
+import fingerprint
+import metacache
 
 #Adjust paths here.
 #do yourself a favor and don't dump into the Users folder (or it might complain about permission)
@@ -17,11 +27,50 @@ import res
 gameDirectory   = r"D:\Games\OriginGames\Need for Speed(TM) Rivals"
 targetDirectory = r"E:\GameRips\NFS\NFSR\pc\dump"
 
+#Number of processes used to dump TOC files in parallel, 1 dumps them one at a time.
+numProcesses    = 1
+
+#Number of threads used to extract the files of a single bundle, 1 extracts them one at a time.
+numThreads      = 1
+
+#Number of threads used to decompress the blocks of a single large payload (e.g. movies), 1 decompresses them one at a time.
+numBlockThreads = 1
+
+#Extract the files of each TOC in the order they're stored in the archives instead of bundle order (helps a lot on HDD and network drives).
+sortReads       = True
+
+#Payloads listed several times under different names are extracted once and copied (cloned on Btrfs/XFS).
+#Set to True to hardlink them instead, saves disk space but editing one of the files changes all of its copies.
+linkDuplicates  = False
+
+#Only extract bundles and TOC chunks that were added or changed since the last dump into targetDirectory (e.g. after a game update).
+#Files are overwritten and the EBX GUID and RES tables of the last dump are updated.
+#The fingerprints telling what changed are only kept in this mode, so the first incremental dump extracts everything.
+incremental     = False
+
+#Continue an interrupted dump, TOCs and bundles it finished are skipped (see journal.py).
+resume          = False
+
+#Memory-map sb, cas and das archives instead of reading them through file handles, needs 64-bit Python.
+useMmap         = False
+
+#Keep decrypted and parsed TOCs, cats and dal in targetDirectory so the next run can skip reading them (see metacache.py).
+metadataCache   = False
+
+#Memory used per process to keep decompressed base blocks of patched payloads around for other payloads patched against them, 0 to disable.
+baseBlockCacheSize = 64*1024*1024
+
 #####################################
 #####################################
 
-def dump(tocPath,baseTocPath,outPath):
-    """Take the filename of a toc and dump all files to the targetFolder."""
+#Payloads less than maxReadGap bytes apart are read ahead together, up to maxReadAhead bytes at once.
+maxReadGap=0x100000
+maxReadAhead=0x4000000
+
+def dump(tocPath,baseTocPath,outPath,movedPaths=None):
+    """Take the filename of a toc and dump all files to the targetFolder.
+
+    movedPaths are files the toc has to extract again in an incremental dump because they used to belong to another toc (see updateOwners)."""
 
     #Depending on how you look at it, there can be up to 2*(3*3+1)=20 different cases:
     #    The toc has a cas flag which means all assets are stored in the cas archives. => 2 options
@@ -35,230 +84,696 @@ def dump(tocPath,baseTocPath,outPath):
     #Additionally, add some common fields to the ebx/res/chunks entries so they can be treated the same.
     #=> 6 cases.
 
-    toc=dbo.readToc(tocPath)
-    if not (toc.get("bundles") or toc.get("chunks")): return #there's nothing to extract (the sb might not even exist)
-
-    sbPath=tocPath[:-3]+"sb"
-    sb=open(sbPath,"rb")
-
     chunkPathToc=os.path.join(outPath,"chunks")
     bundlePath=os.path.join(outPath,"bundles")
     ebxPath=os.path.join(bundlePath,"ebx")
     resPath=os.path.join(bundlePath,"res")
     chunkPath=os.path.join(bundlePath,"chunks")
 
-    ###read the bundle depending on the four types (+cas+delta, +cas-delta, -cas+delta, -cas-delta) and choose the right function to write the payload
-    if toc.get("cas"):
-        for tocEntry in toc.get("bundles"): #id offset size, size is redundant
-            if tocEntry.get("base"): continue #Patched bundle. However, use the unpatched bundle because no file was patched at all.
-
-            sb.seek(tocEntry.get("offset"))
-            bundle=dbo.DbObject(sb)
-                    
-            #pick the right function
-            if tocEntry.get("delta"):
-                writePayload=payload.casPatchedBundlePayload
-            else:
-                writePayload=payload.casBundlePayload
-
-            for entry in bundle.get("ebx",list()): #name sha1 size originalSize
-                path=os.path.join(ebxPath,entry.get("name")+".ebx")
-                if writePayload(entry,path,False):
-                    ebx.addEbxGuid(path,ebxPath)
-
-            for entry in bundle.get("res",list()): #name sha1 size originalSize resRid resType resMeta
-                res.addToResTable(entry.get("resRid"),entry.get("name"),entry.get("resType"),entry.get("resMeta"))
-                path=os.path.join(resPath,entry.get("name")+res.getResExt(entry.get("resType")))
-                writePayload(entry,path,False)
-
-            for entry in bundle.get("chunks",list()): #id sha1 size logicalOffset logicalSize chunkMeta::h32 chunkMeta::meta
-                path=os.path.join(chunkPath,entry.get("id").format()+".chunk")
-                writePayload(entry,path,True)
-
-        #Deal with the chunks which are defined directly in the toc.
-        #These chunks do NOT know their originalSize.
-        for entry in toc.get("chunks"): #id sha1
-            targetPath=os.path.join(chunkPathToc,entry.get("id").format()+".chunk")
-            payload.casChunkPayload(entry,targetPath)
-    else:
-        for tocEntry in toc.get("bundles"): #id offset size, size is redundant
-            if tocEntry.get("base"): continue #Patched bundle. However, use the unpatched bundle because no file was patched at all.
-
-            sb.seek(tocEntry.get("offset"))
-
-            if tocEntry.get("delta"):
-                #The sb currently points at the delta file.
-                #Read the unpatched toc of the same name to get the base bundle.
-                baseToc=dbo.readToc(baseTocPath)
-                for baseTocEntry in baseToc.get("bundles"):
-                    if baseTocEntry.get("id").lower() == tocEntry.get("id").lower():
-                        break
-                else: #if no base bundle has with this name has been found:
-                    pass #use the last base bundle. This is okay because it is actually not used at all (the delta has uses instructionType 3 only).
-                    
-                basePath=baseTocPath[:-3]+"sb"
-                base=open(basePath,"rb")
-                base.seek(baseTocEntry.get("offset"))
-                bundle=noncas.patchedBundle(base, sb) #create a patched bundle using base and delta
-                base.close()
-                writePayload=payload.noncasPatchedBundlePayload
-                sourcePath=[basePath,sbPath] #base, delta
-            else:
-                bundle=noncas.unpatchedBundle(sb)
-                writePayload=payload.noncasBundlePayload
-                sourcePath=sbPath
+    if tocPath in journal.tocs and movedPaths is None:
+        #Extracted completely by an interrupted dump, just restore its RES and EBX table entries and its fingerprints.
+        bundleKeys, fingerprint.current[tocPath] = journal.tocs[tocPath]
+        addEbxGuids([restoreBundle(key) for key in bundleKeys],ebxPath)
+        return
 
-            for entry in bundle.ebx:
-                path=os.path.join(ebxPath,entry.name+".ebx")
-                if writePayload(entry,path,sourcePath):
-                    ebx.addEbxGuid(path,ebxPath)
+    sbPath=tocPath[:-3]+"sb"
+    baseSbPath=baseTocPath[:-3]+"sb" if baseTocPath else None
+    record=[fingerprint.statFiles(tocPath,sbPath,baseTocPath,baseSbPath),0,dict(),set(),dict()]
+    previous=fingerprint.previous.get(tocPath) if incremental else None
+    if previous and previous[0]==record[0] and not previous[1] and movedPaths is None:
+        #Nothing has changed since the last dump.
+        fingerprint.current[tocPath]=previous
+        return
+    fingerprint.current[tocPath]=record
 
-            for entry in bundle.res:
-                res.addToResTable(entry.resRid,entry.name,entry.resType,entry.resMeta)
-                path=os.path.join(resPath,entry.name+res.getResExt(entry.resType))
-                writePayload(entry,path,sourcePath)
+    toc=dbo.readToc(tocPath)
+    if not (toc.get("bundles") or toc.get("chunks")): return #there's nothing to extract (the sb might not even exist)
 
-            for entry in bundle.chunks:
-                path=os.path.join(chunkPath,entry.id.format()+".chunk")
-                writePayload(entry,path,sourcePath)
+    sb=archive.openFile(sbPath)
 
-        #Deal with the chunks which are defined directly in the toc.
-        #These chunks do NOT know their originalSize.
-        for entry in toc.get("chunks"): #id offset size
-            targetPath=os.path.join(chunkPathToc,entry.get("id").format()+".chunk")
-            payload.noncasChunkPayload(entry,targetPath,sbPath)
+    bundles=list()
+    base=None
+    try:
+        ###read the bundle depending on the four types (+cas+delta, +cas-delta, -cas+delta, -cas-delta) and choose the right function to write the payload
+        if toc.get("cas"):
+            for tocEntry in toc.get("bundles"): #id offset size, size is redundant
+                if tocEntry.get("base"): continue #Patched bundle. However, use the unpatched bundle because no file was patched at all.
 
-    sb.close()
+                key=tocPath, tocEntry.get("id"), tocEntry.get("offset")
+                if key in journal.bundles and movedPaths is None:
+                    bundles.append(restoreBundle(key))
+                    continue
 
+                sb.seek(tocEntry.get("offset"))
+                bundle=dbo.readDbObject(sb)
+
+                #pick the right function
+                if tocEntry.get("delta"):
+                    writePayload=payload.casPatchedBundlePayload
+                else:
+                    writePayload=payload.casBundlePayload
+
+                bundleTasks=BundleTasks(key)
+                for entry in bundle.get("ebx",list()): #name sha1 size originalSize
+                    path=os.path.join(ebxPath,entry.get("name")+".ebx")
+                    bundleTasks.ebxTasks.append((writePayload,entry,path,False))
+
+                for entry in bundle.get("res",list()): #name sha1 size originalSize resRid resType resMeta
+                    bundleTasks.addRes(entry.get("resRid"),entry.get("name"),entry.get("resType"),entry.get("resMeta"))
+                    path=os.path.join(resPath,entry.get("name")+res.getResExt(entry.get("resType")))
+                    bundleTasks.tasks.append((writePayload,entry,path,False))
+
+                for entry in bundle.get("chunks",list()): #id sha1 size logicalOffset logicalSize chunkMeta::h32 chunkMeta::meta
+                    path=os.path.join(chunkPath,entry.get("id").format()+".chunk")
+                    bundleTasks.tasks.append((writePayload,entry,path,True))
+
+                fingerprintBundle(bundleTasks,tocEntry.get("id"),previous,record)
+                bundles.append(bundleTasks)
+
+            #Deal with the chunks which are defined directly in the toc.
+            #These chunks do NOT know their originalSize.
+            tocChunks=BundleTasks(None)
+            for entry in toc.get("chunks"): #id sha1
+                targetPath=os.path.join(chunkPathToc,entry.get("id").format()+".chunk")
+                task=payload.casChunkPayload,entry,targetPath
+                tocChunks.tasks.append(task)
+                fingerprintChunk(tocChunks,task,previous,record)
+            bundles.append(tocChunks)
+        else:
+            baseBundles=dict() #lowercase id -> entry of the base toc
+            for tocEntry in toc.get("bundles"): #id offset size, size is redundant
+                if tocEntry.get("base"): continue #Patched bundle. However, use the unpatched bundle because no file was patched at all.
 
+                key=tocPath, tocEntry.get("id"), tocEntry.get("offset")
+                if key in journal.bundles and movedPaths is None:
+                    bundles.append(restoreBundle(key))
+                    continue
+
+                sb.seek(tocEntry.get("offset"))
+
+                if tocEntry.get("delta"):
+                    #The sb currently points at the delta file.
+                    #Read the unpatched toc of the same name to get the base bundle, only once for all delta bundles.
+                    if base is None:
+                        baseToc=dbo.readToc(baseTocPath)
+                        for baseTocEntry in baseToc.get("bundles"):
+                            baseBundles.setdefault(baseTocEntry.get("id").lower(),baseTocEntry)
+                        lastBaseTocEntry=baseTocEntry
+                        basePath=baseTocPath[:-3]+"sb"
+                        base=archive.openFile(basePath)
+
+                    #If no base bundle with this name has been found, use the last base bundle.
+                    #This is okay because it is actually not used at all (the delta has uses instructionType 3 only).
+                    baseTocEntry=baseBundles.get(tocEntry.get("id").lower(),lastBaseTocEntry)
+                    base.seek(baseTocEntry.get("offset"))
+                    bundle=noncas.patchedBundle(base, sb) #create a patched bundle using base and delta
+                    writePayload=payload.noncasPatchedBundlePayload
+                    sourcePath=[basePath,sbPath] #base, delta
+                else:
+                    bundle=noncas.unpatchedBundle(sb)
+                    writePayload=payload.noncasBundlePayload
+                    sourcePath=sbPath
+
+                #All payloads of the bundle are extracted in one pass over its data, the tasks say which file each entry goes to.
+                bundleTasks=BundleTasks(key)
+                bundleTasks.stream=writePayload, bundle, sourcePath
+                bundleTasks.location=sbPath, tocEntry.get("offset"), tocEntry.get("size")
+                for entry in bundle.ebx:
+                    path=os.path.join(ebxPath,entry.name+".ebx")
+                    bundleTasks.ebxTasks.append((writePayload,entry,path,sourcePath))
+
+                for entry in bundle.res:
+                    bundleTasks.addRes(entry.resRid,entry.name,entry.resType,entry.resMeta)
+                    path=os.path.join(resPath,entry.name+res.getResExt(entry.resType))
+                    bundleTasks.tasks.append((writePayload,entry,path,sourcePath))
+
+                for entry in bundle.chunks:
+                    path=os.path.join(chunkPath,entry.id.format()+".chunk")
+                    bundleTasks.tasks.append((writePayload,entry,path,sourcePath))
+
+                fingerprintBundle(bundleTasks,tocEntry.get("id"),previous,record)
+                bundles.append(bundleTasks)
+
+            #Deal with the chunks which are defined directly in the toc.
+            #These chunks do NOT know their originalSize.
+            tocChunks=BundleTasks(None)
+            for entry in toc.get("chunks"): #id offset size
+                targetPath=os.path.join(chunkPathToc,entry.get("id").format()+".chunk")
+                task=payload.noncasChunkPayload,entry,targetPath,sbPath
+                tocChunks.tasks.append(task)
+                fingerprintChunk(tocChunks,task,previous,record)
+            bundles.append(tocChunks)
+    finally:
+        sb.close()
+        if base: base.close()
+
+    #Extracting the files of a TOC is mostly spent in zlib/LZ4/Zstd which release the GIL so threads can run them concurrently.
+    pool=concurrent.futures.ThreadPoolExecutor(numThreads) if numThreads>1 else None
+    try:
+        extractTasks(pool,bundles,ebxPath,selectTasks(tocPath,bundles,previous,record,movedPaths))
+        addEbxGuids(bundles,ebxPath)
+        journal.addToc(tocPath,[bundleTasks.key for bundleTasks in bundles if bundleTasks.key],record)
+    finally:
+        if pool: pool.shutdown(cancel_futures=True) #tasks still queued after a failure are dropped
+
+class BundleTasks:
+    """Extraction tasks of a bundle. Each task is (writePayload, entry, targetPath[, extra argument]).
+
+    Non-cas bundles have all of their tasks run at once by a single writePayload(bundle, targetPaths, sourcePath) call (stream).
+    Once all tasks are done the bundle goes into the journal along with its RES and EBX table entries."""
+    def __init__(self,key):
+        self.key=key #(tocPath, id, offset), None for TOC chunks
+        self.ebxTasks=list()
+        self.tasks=list()
+        self.stream=None #(writePayload, bundle, sourcePath) for non-cas bundles
+        self.location=None #(sb path, offset, size) of a non-cas bundle
+        self.resRows=list()
+        self.ebxRows=None #(path, guid, name) of extracted EBX, known once the bundle is done
+        self.available=set() #id(task) of tasks whose payload can be extracted
+        self.changed=set() #id(task) of tasks that changed since the last dump
+        self.paths=None #target paths of the available tasks, only kept for bundles restored from the journal
+        self.pending=0
+
+    def addRes(self,resRid,name,resType,resMeta):
+        res.addToResTable(resRid,name,resType,resMeta)
+        self.resRows.append((resRid,name,resType,resMeta))
+
+def fingerprintBundle(bundleTasks,bundleId,previous,record):
+    #Fingerprint the bundle for the next incremental dump. Its tasks have changed unless the previous dump extracted the same files.
+    allTasks=bundleTasks.ebxTasks+bundleTasks.tasks
+    values=list()
+    for task in allTasks:
+        description, available = payload.describePayload(task)
+        values.append((description,available))
+        if available: bundleTasks.available.add(id(task))
+        else: record[1]+=1
+
+    digest=fingerprint.digest(values)
+    record[2][bundleId]=digest
+    if not previous or previous[2].get(bundleId)!=digest:
+        bundleTasks.changed.update(id(task) for task in allTasks)
+
+def fingerprintChunk(tocChunks,task,previous,record):
+    #Same for TOC chunks. Non-cas ones only have an offset in the sb, so they change whenever the sb does.
+    description, available = payload.describePayload(task)
+    if available: tocChunks.available.add(id(task))
+    else: record[1]+=1
+
+    digest=fingerprint.digest((description,available,record[0] if task[0]==payload.noncasChunkPayload else None))
+    record[3].add(digest)
+    if not previous or digest not in previous[3]:
+        tocChunks.changed.add(id(task))
+
+def selectTasks(tocPath,bundles,previous,record,movedPaths=None):
+    """Record which bundle owns each file of the TOC and return the ids of the tasks an incremental dump runs (None to run all).
+
+    The owner of a file is the first bundle (or the TOC chunks, owner None) that can extract it, the one writing it in a full dump.
+    An incremental dump only writes a file again if its owner has changed or another bundle owned it last time, and only the owner writes it.
+    Files another TOC owned last time are left to that TOC, if it doesn't list them anymore they're moved later on (see updateOwners)."""
+    owners=record[4] #targetPath -> bundle id
+    writers=dict() #targetPath -> task of the owner
+    for bundleTasks in bundles:
+        ownerId=bundleTasks.key[1] if bundleTasks.key else None
+        if bundleTasks.ebxRows is not None:
+            #Restored from the journal.
+            for targetPath in bundleTasks.paths:
+                owners.setdefault(targetPath,ownerId)
+            continue
+
+        for task in bundleTasks.ebxTasks+bundleTasks.tasks:
+            if task[2] not in owners and id(task) in bundleTasks.available:
+                owners[task[2]]=ownerId
+                writers[task[2]]=task, bundleTasks
+
+    if not incremental: return None
+    if movedPaths is not None:
+        return set(id(writers[targetPath][0]) for targetPath in movedPaths if targetPath in writers)
+
+    selected=set()
+    for targetPath, (task, bundleTasks) in writers.items():
+        if fingerprint.getOwnerToc(targetPath) not in (None,tocPath): continue
+        if not previous or id(task) in bundleTasks.changed or \
+            targetPath not in previous[4] or previous[4][targetPath]!=owners[targetPath]:
+            selected.add(id(task))
+    return selected
+
+def restoreBundle(key):
+    #Bundle extracted by an interrupted dump, only its RES and EBX table entries and the files it owns are needed.
+    resRows, ebxRows, paths = journal.bundles[key]
+    bundleTasks=BundleTasks(key)
+    bundleTasks.paths=paths
+    for row in resRows:
+        bundleTasks.addRes(*row)
+    bundleTasks.ebxRows=ebxRows
+    return bundleTasks
+
+def extractTasks(pool,bundles,ebxPath,selected=None):
+    #Tasks writing the same file are kept together and run one after another in bundle order,
+    #so the file comes from the same entry as when extracting bundle by bundle (the first one that can be written wins).
+    #Non-cas bundles are extracted in one pass each. Non-cas payloads can always be written, so a bundle only writes
+    #the files no earlier bundle writes and its other tasks are done without doing anything.
+    #If selected (ids of tasks) is given, the other tasks are done without doing anything too.
+    groups=dict() #targetPath -> tasks
+    units=list() #(location, tasks, bundleTasks), bundleTasks only for non-cas bundles
+    owners=dict() #id(task) -> BundleTasks
+    ebxTasks=set()
+    results=dict() #id(task) -> result, getEbxGuid result for extracted EBX
+    lock=threading.Lock()
+
+    def finishTask(task,result):
+        writePayload, entry, targetPath = task[:3]
+        if result:
+            if targetPath not in journal.payloads:
+                sha1=entry.get("sha1") if isinstance(entry,(dbo.DbDict,dbo.DbView)) else None
+                journal.addPayload(targetPath,sha1,os.path.getsize(payload.lp(targetPath)))
+            if id(task) in ebxTasks:
+                result=ebx.getEbxGuid(targetPath,ebxPath)
+
+        owner=owners[id(task)]
+        with lock:
+            results[id(task)]=result
+            owner.pending-=1
+            done=owner.pending==0
+        if done:
+            finishBundle(owner,results)
+
+    for bundleTasks in bundles:
+        if bundleTasks.ebxRows is not None: continue
+        allTasks=bundleTasks.ebxTasks+bundleTasks.tasks
+        for task in allTasks:
+            owners[id(task)]=bundleTasks
+        ebxTasks.update(id(task) for task in bundleTasks.ebxTasks)
+        bundleTasks.pending=len(allTasks)
+        if not bundleTasks.pending:
+            finishBundle(bundleTasks,results)
+            continue
+
+        runTasks=allTasks
+        if selected is not None:
+            runTasks=[task for task in allTasks if id(task) in selected]
+
+        if bundleTasks.stream:
+            owned=list()
+            for task in runTasks:
+                if task[2] not in groups:
+                    groups[task[2]]=None
+                    owned.append(task)
+            if owned:
+                units.append((bundleTasks.location,owned,bundleTasks))
+            else:
+                for task in allTasks:
+                    finishTask(task,None) #nothing to write, no need to read the bundle
+        else:
+            for task in runTasks:
+                group=groups.get(task[2])
+                if group is None:
+                    group=groups[task[2]]=list()
+                    units.append((None,group,None))
+                group.append(task)
+            if runTasks is not allTasks:
+                runIds=set(id(task) for task in runTasks)
+                for task in allTasks:
+                    if id(task) not in runIds: finishTask(task,None)
+    units=[(location or payload.locatePayload(tasks[0]),tasks,bundleTasks) for location, tasks, bundleTasks in units]
+
+    if sortReads:
+        units=planReads(units)
+    else:
+        units=[(None,tasks,bundleTasks) for location, tasks, bundleTasks in units]
+
+    def runUnit(item):
+        span, tasks, bundleTasks = item
+        if span and span[2]>0:
+            archive.readAhead(*span)
+
+        if bundleTasks:
+            owned=set(id(task) for task in tasks)
+            allTasks=bundleTasks.ebxTasks+bundleTasks.tasks
+            writePayload, bundle, sourcePath = bundleTasks.stream
+            writePayload(bundle,[task[2] if id(task) in owned else None for task in allTasks],sourcePath)
+            for task in allTasks:
+                finishTask(task,True if id(task) in owned else None) #the other tasks are left to the bundles writing their files
+        else:
+            for task in tasks:
+                finishTask(task,task[0](*task[1:]))
+
+    if pool:
+        #Every task writes to its own temporary file, duplicate target paths are resolved when renaming.
+        list(pool.map(runUnit,units))
+    else:
+        for unit in units:
+            runUnit(unit)
+
+def finishBundle(bundleTasks,results):
+    bundleTasks.ebxRows=[(task[2],)+results[id(task)] for task in bundleTasks.ebxTasks if results[id(task)]]
+    if bundleTasks.key:
+        paths=[task[2] for task in bundleTasks.ebxTasks+bundleTasks.tasks if id(task) in bundleTasks.available]
+        journal.addBundle(bundleTasks.key,bundleTasks.resRows,bundleTasks.ebxRows,paths)
+
+def addEbxGuids(bundles,ebxPath):
+    #EBX GUIDs are added once all files are written, in bundle order.
+    for bundleTasks in bundles:
+        for path, guid, name in bundleTasks.ebxRows:
+            ebx.addEbxGuid(path,ebxPath,(guid,name))
+
+def planReads(units):
+    #Order the units (task groups and non-cas bundles) by archive and offset so the archives are read front to back instead of jumping around.
+    #Payloads that are close together are merged into spans of up to maxReadAhead bytes, each span is read ahead
+    #in one go before its first payload is extracted. Returns (span, tasks, bundleTasks), span is (path, offset, size) or None.
+    located=list()
+    unknown=list()
+    for location, tasks, bundleTasks in units:
+        if location:
+            located.append((location,tasks,bundleTasks))
+        else:
+            unknown.append((None,tasks,bundleTasks))
+
+    located.sort(key=lambda item: item[0][:2])
+
+    planned=list()
+    spanStart=None
+    for (path, offset, size), tasks, bundleTasks in located:
+        if spanStart and spanStart[0]==path and offset<=spanEnd+maxReadGap and offset+size-spanStart[1]<=maxReadAhead:
+            spanEnd=max(spanEnd,offset+size)
+            spanStart[2]=spanEnd-spanStart[1]
+            planned.append((None,tasks,bundleTasks))
+        else:
+            spanStart=[path,offset,size]
+            spanEnd=offset+size
+            planned.append((spanStart,tasks,bundleTasks))
+
+    return planned+unknown
+
+baseTocs=dict() #tocPath -> unpatched tocPath or None, for every TOC found by dumpRoot
 
 def dumpRoot(dataDir,patchDir,outPath):
     os.makedirs(outPath,exist_ok=True)
 
+    #Patched TOC is always extracted before the unpatched one so keep them together in a single job.
+    jobs=list()
     for dir0, dirs, ff in os.walk(dataDir):
         for fname in ff:
             if fname[-4:]==".toc":
                 fname=os.path.join(dir0,fname)
                 localPath=os.path.relpath(fname,dataDir)
-                print(localPath)
 
                 #Check if there's a patched version and extract it first.
                 patchedName=os.path.join(patchDir,localPath)
-                if os.path.isfile(patchedName):
-                    dump(patchedName,fname,outPath)
-
-                dump(fname,None,outPath)
+                if not os.path.isfile(patchedName):
+                    patchedName=None
+
+                jobs.append((localPath,fname,patchedName,outPath))
+                baseTocs[fname]=None
+                if patchedName: baseTocs[patchedName]=fname
+
+    if numProcesses<=1:
+        for job in jobs:
+            print(job[0])
+            dumpJob(job)
+        return
+
+    #Each worker fills its own EBX GUID and RES tables, merge them in the same order the TOCs would be dumped in one by one.
+    pool=multiprocessing.Pool(numProcesses,initDumpWorker,(cas.catDict,outPath,fingerprint.previous,payload.dumpStartTime))
+    for localPath, guidTable, resTable, unkResTypes, workerStats, fingerprints in pool.imap(dumpWorker,jobs):
+        print(localPath)
+        addStats(workerStats)
+        fingerprint.current.update(fingerprints)
+        ebx.guidTable.update(guidTable)
+        res.resTable.update(resTable)
+        for typ in unkResTypes:
+            if typ not in res.unkResTypes:
+                res.unkResTypes.append(typ)
+    pool.close()
+    pool.join()
+
+def updateOwners(outPath):
+    #Incremental dumps only look at the files each TOC lists. Files the TOC owning them last time doesn't list anymore
+    #may belong to another TOC now which skipped them (see selectTasks), that TOC extracts them now.
+    #Files no TOC lists anymore are deleted along with their EBX GUID and RES table entries.
+    previousOwners=fingerprint.findOwnerTocs(fingerprint.previous)
+    currentOwners=fingerprint.findOwnerTocs(fingerprint.current)
+    movedPaths=dict() #tocPath -> files it has to extract
+    for targetPath, tocPath in currentOwners.items():
+        if previousOwners.get(targetPath) not in (None,tocPath):
+            movedPaths.setdefault(tocPath,set()).add(targetPath)
+
+    for tocPath, paths in movedPaths.items():
+        print("%s (%d files moved from other TOCs)" % (tocPath,len(paths)))
+        dump(tocPath,baseTocs[tocPath],outPath,paths)
+
+    removedPaths=[targetPath for targetPath in previousOwners if targetPath not in currentOwners]
+    if not removedPaths: return
+    print("Removing %d files which are not in the game anymore..." % len(removedPaths))
+    for targetPath in removedPaths:
+        try:
+            os.remove(payload.lp(targetPath))
+        except FileNotFoundError:
+            pass
+
+    #Table entries are matched by the files they point to.
+    removed=set(os.path.normpath(targetPath).lower() for targetPath in removedPaths)
+    ebxPath=os.path.join(outPath,"bundles","ebx")
+    resPath=os.path.join(outPath,"bundles","res")
+    for guid, name in list(ebx.guidTable.items()):
+        if os.path.normpath(os.path.join(ebxPath,name+".ebx")).lower() in removed:
+            del ebx.guidTable[guid]
+    for resRid, resInfo in list(res.resTable.items()):
+        if os.path.normpath(os.path.join(resPath,resInfo.getResFilename())).lower() in removed:
+            del res.resTable[resRid]
+
+def dumpJob(job):
+    localPath, fname, patchedName, outPath = job
+    if patchedName:
+        dump(patchedName,fname,outPath)
+
+    dump(fname,None,outPath)
+
+def initDumpWorker(catDict,outPath,previousFingerprints,dumpStartTime):
+    cas.catDict=catDict
+    if metadataCache: metacache.start(outPath)
+    journal.start(outPath,resume,False)
+    payload.tempDir=journal.getTempDir(outPath)
+    fingerprint.previous.update(previousFingerprints)
+    payload.refreshFiles=incremental
+    payload.dumpStartTime=dumpStartTime
+    payload.numBlockThreads=numBlockThreads
+    payload.linkDuplicates=linkDuplicates
+    archive.useMmap=useMmap
+    payload.baseBlockCacheSize=baseBlockCacheSize
+    payload.zstdInit()
+    res.loadResNames()
+
+def dumpWorker(job):
+    ebx.guidTable.clear()
+    ebx.parsedEbx.clear()
+    res.resTable.clear()
+    res.unkResTypes.clear()
+    fingerprint.current.clear()
+    dumpJob(job)
+    return job[0], ebx.guidTable, res.resTable, res.unkResTypes, takeStats(), fingerprint.current
+
+#Counters summed over all processes: archive handle pool hits, misses, evictions, reused payloads and decompressed bytes avoided,
+#base block cache hits and misses, metadata cache hits and misses.
+stats=[0,0,0,0,0,0,0,0,0]
+
+def takeStats():
+    return archive.pool.takeStats()+payload.takeReuseStats()+payload.baseBlocks.takeStats()+metacache.takeStats()
+
+def addStats(values):
+    for i in range(len(stats)):
+        stats[i]+=values[i]
 
 def findCats(dataDir,patchDir,readCat):
     #Read all cats in the specified directory.
+    #A patched cat comes right after its base cat so its entries replace the base ones, same order on every run.
+    cats=list() #(message, path)
     for dir0, dirs, ff in os.walk(dataDir):
-        for fname in ff:
+        dirs.sort()
+        for fname in sorted(ff):
             if fname=="cas.cat":
                 fname=os.path.join(dir0,fname)
                 localPath=os.path.relpath(fname,dataDir)
-                print("Reading %s..." % localPath)
-                readCat(fname)
+                cats.append(("Reading %s..." % localPath,fname))
 
                 #Check if there's a patched version.
                 patchedName=os.path.join(patchDir,localPath)
                 if os.path.isfile(patchedName):
-                    print("Reading patched %s..." % os.path.relpath(patchedName,patchDir))
-                    readCat(patchedName)
+                    cats.append(("Reading patched %s..." % os.path.relpath(patchedName,patchDir),patchedName))
+
+    if numProcesses<=1 or len(cats)<=1:
+        for message, catPath in cats:
+            print(message)
+            readCat(catPath)
+        return
+
+    #Parse the cats in parallel and merge them in the order above.
+    start=time.perf_counter()
+    readTime=0
+    pool=multiprocessing.Pool(min(numProcesses,len(cats)))
+    jobs=[(readCat,catPath,metacache.cacheDir) for message, catPath in cats]
+    for (message, catPath), (catIndex, elapsed, cacheStats) in zip(cats,pool.imap(readCatWorker,jobs)):
+        print(message)
+        cas.catDict.update(catIndex)
+        readTime+=elapsed
+        metacache.hits+=cacheStats[0]
+        metacache.misses+=cacheStats[1]
+    pool.close()
+    pool.join()
+
+    elapsed=time.perf_counter()-start
+    print("Read %d cats in %.1f s, the workers took %.1f s for them in total." % (len(cats),elapsed,readTime))
+
+def readCatWorker(job):
+    #Returns the time it took too.
+    readCat, catPath, cacheDir = job
+    metacache.cacheDir=cacheDir
+    start=time.perf_counter()
+    cas.catDict=cas.CatIndex()
+    readCat(catPath)
+    cas.catDict.finish()
+    return cas.catDict, time.perf_counter()-start, metacache.takeStats()
+
+if __name__=="__main__":
+    #make the paths absolute and normalize the slashes
+    gameDirectory=os.path.normpath(gameDirectory)
+    targetDirectory=os.path.normpath(targetDirectory) #it's an absolute path already
+    payload.numBlockThreads=numBlockThreads
+    payload.linkDuplicates=linkDuplicates
+    archive.useMmap=useMmap
+    payload.baseBlockCacheSize=baseBlockCacheSize
+    payload.zstdInit()
+
+    print("Compression backends:")
+    for line in codec.describe():
+        print("    "+line)
+
+    print("Loading RES names...")
+    res.loadResNames()
+
+    if incremental and os.path.isfile(fingerprint.getPath(targetDirectory)):
+        print("Loading fingerprints and tables of the last dump...")
+        fingerprint.load(targetDirectory)
+        ebx.loadGuidTable(targetDirectory)
+        res.loadResTable(targetDirectory)
+        res.loadUnknownResTypes(targetDirectory)
+    payload.refreshFiles=incremental
+    payload.dumpStartTime=time.time()
+
+    if metadataCache:
+        metacache.start(targetDirectory)
+
+    if not resume:
+        journal.clear(targetDirectory)
+    journal.start(targetDirectory,resume)
+    payload.tempDir=journal.getTempDir(targetDirectory)
+    os.makedirs(payload.tempDir,exist_ok=True)
+    if journal.tocs or journal.bundles:
+        print("Resuming, %d TOCs and %d bundles were finished before." % (len(journal.tocs),len(journal.bundles)))
+
+    #Load layout.toc
+    tocLayout=dbo.readToc(os.path.join(gameDirectory,"Data","layout.toc"))
+
+    if tocLayout.getSubObject("installManifest") is None or \
+        tocLayout.getSubObject("installManifest").getSubObject("installChunks") is None:
+        if not os.path.isfile(os.path.join(gameDirectory,"Data","das.dal")):
+            #Old layout similar to Frostbite 2 with a single cas.cat.
+            #Can also be non-cas.
+            dataDir=os.path.join(gameDirectory,"Data")
+            updateDir=os.path.join(gameDirectory,"Update")
+            patchDir=os.path.join(updateDir,"Patch","Data")
+
+            if tocLayout.getSubObject("installManifest") is None:
+                readCat=cas.readCat1
+            else:
+                readCat=cas.readCat2 #Star Wars: Battlefront Beta
 
-#make the paths absolute and normalize the slashes
-gameDirectory=os.path.normpath(gameDirectory)
-targetDirectory=os.path.normpath(targetDirectory) #it's an absolute path already
-payload.zstdInit()
+            catPath=os.path.join(dataDir,"cas.cat") #Seems to always be in the same place.
+            if os.path.isfile(catPath):
+                print("Reading cat entries...")
+                readCat(catPath)
 
-print("Loading RES names...")
-res.loadResNames()
+                #Check if there's a patched version.
+                patchedCat=os.path.join(patchDir,os.path.relpath(catPath,dataDir))
+                if os.path.isfile(patchedCat):
+                    print("Reading patched cat entries...")
+                    readCat(patchedCat)
+
+            if os.path.isdir(updateDir):
+                #First, extract all DLCs.
+                for dir in os.listdir(updateDir):
+                    if dir=="Patch":
+                        continue
+
+                    print("Extracting DLC %s..." % dir)
+                    dumpRoot(os.path.join(updateDir,dir,"Data"),patchDir,targetDirectory)
+
+            #Now extract the base game.
+            print("Extracting main game...")
+            dumpRoot(dataDir,patchDir,targetDirectory)
+        else:
+            #Special case for Need for Speed: Edge. Same as early FB3 but uses das.dal instead of cas.cat.
+            dataDir=os.path.join(gameDirectory,"Data")
 
-#Load layout.toc
-tocLayout=dbo.readToc(os.path.join(gameDirectory,"Data","layout.toc"))
+            print("Reading dal entries...")
+            dalPath=os.path.join(dataDir,"das.dal")
+            das.readDal(dalPath)
 
-if not tocLayout.getSubObject("installManifest") or \
-    not tocLayout.getSubObject("installManifest").getSubObject("installChunks"):
-    if not os.path.isfile(os.path.join(gameDirectory,"Data","das.dal")):
-        #Old layout similar to Frostbite 2 with a single cas.cat.
-        #Can also be non-cas.
+            print("Extracting main game...")
+            das.dumpRoot(dataDir,targetDirectory)
+            print("Extracting FE...")
+            das.dumpFE(dataDir,targetDirectory,numProcesses)
+    else:
+        #New version with multiple cats split into install groups, seen in 2015 and later games.
+        #Appears to always use cas.cat and never use delta bundles, patch just replaces bundles fully.
         dataDir=os.path.join(gameDirectory,"Data")
         updateDir=os.path.join(gameDirectory,"Update")
-        patchDir=os.path.join(updateDir,"Patch","Data")
+        patchDir=os.path.join(gameDirectory,"Patch")
 
-        if not tocLayout.getSubObject("installManifest"):
-            readCat=cas.readCat1
+        #Detect cat version.
+        if tocLayout.getSubObject("installManifest").get("maxTotalSize")!=None:
+            readCat=cas.readCat3
         else:
-            readCat=cas.readCat2 #Star Wars: Battlefront Beta
-
-        catPath=os.path.join(dataDir,"cas.cat") #Seems to always be in the same place.
-        if os.path.isfile(catPath):
-            print("Reading cat entries...")
-            readCat(catPath)
-
-            #Check if there's a patched version.
-            patchedCat=os.path.join(patchDir,os.path.relpath(catPath,dataDir))
-            if os.path.isfile(patchedCat):
-                print("Reading patched cat entries...")
-                readCat(patchedCat)
+            readCat=cas.readCat4
 
         if os.path.isdir(updateDir):
             #First, extract all DLCs.
             for dir in os.listdir(updateDir):
-                if dir=="Patch":
-                    continue
-
                 print("Extracting DLC %s..." % dir)
-                dumpRoot(os.path.join(updateDir,dir,"Data"),patchDir,targetDirectory)
+                dir=os.path.join(updateDir,dir,"Data")
+                findCats(dir,patchDir,readCat)
+                dumpRoot(dir,patchDir,targetDirectory)
 
         #Now extract the base game.
         print("Extracting main game...")
+        findCats(dataDir,patchDir,readCat)
         dumpRoot(dataDir,patchDir,targetDirectory)
-    else:
-        #Special case for Need for Speed: Edge. Same as early FB3 but uses das.dal instead of cas.cat.
-        dataDir=os.path.join(gameDirectory,"Data")
 
-        print("Reading dal entries...")
-        dalPath=os.path.join(dataDir,"das.dal")
-        das.readDal(dalPath)
+    if not os.path.isdir(targetDirectory):
+        print("Nothing was extracted, did you set input path correctly?")
+        sys.exit(1)
 
-        print("Extracting main game...")
-        das.dumpRoot(dataDir,targetDirectory)
-        print("Extracting FE...")
-        das.dumpFE(dataDir,targetDirectory)
-else:
-    #New version with multiple cats split into install groups, seen in 2015 and later games.
-    #Appears to always use cas.cat and never use delta bundles, patch just replaces bundles fully.
-    dataDir=os.path.join(gameDirectory,"Data")
-    updateDir=os.path.join(gameDirectory,"Update")
-    patchDir=os.path.join(gameDirectory,"Patch")
-
-    #Detect cat version.
-    if tocLayout.getSubObject("installManifest").get("maxTotalSize")!=None:
-        readCat=cas.readCat3
-    else:
-        readCat=cas.readCat4
+    if incremental:
+        updateOwners(targetDirectory)
 
-    if os.path.isdir(updateDir):
-        #First, extract all DLCs.
-        for dir in os.listdir(updateDir):
-            print("Extracting DLC %s..." % dir)
-            dir=os.path.join(updateDir,dir,"Data")
-            findCats(dir,patchDir,readCat)
-            dumpRoot(dir,patchDir,targetDirectory)
+    print("Writing EBX GUID table...")
+    ebx.writeGuidTable(targetDirectory)
 
-    #Now extract the base game.
-    print("Extracting main game...")
-    findCats(dataDir,patchDir,readCat)
-    dumpRoot(dataDir,patchDir,targetDirectory)
+    print ("Writing RES table...")
+    res.writeResTable(targetDirectory)
 
-if not os.path.isdir(targetDirectory):
-    print("Nothing was extracted, did you set input path correctly?")
-    sys.exit(1)
+    addStats(takeStats())
+    print("Archive handles: %d hits, %d misses, %d evictions" % tuple(stats[:3]))
+    print("Duplicate payloads: %d copied instead of decompressed, %.1f MB saved" % (stats[3],stats[4]/1024/1024))
+    if stats[5]+stats[6]:
+        print("Base block cache: %d hits, %d misses (%.1f%% hit rate)" % (stats[5],stats[6],stats[5]*100/(stats[5]+stats[6])))
+    if metadataCache:
+        print("Metadata cache: %d files read from the cache, %d parsed" % (stats[7],stats[8]))
 
-print("Writing EBX GUID table...")
-ebx.writeGuidTable(targetDirectory)
+    if incremental: fingerprint.save(targetDirectory)
 
-print ("Writing RES table...")
-res.writeResTable(targetDirectory)
+    #The dump is complete, nothing to resume anymore.
+    journal.close()
+    journal.clear(targetDirectory)
 
-payload.zstdCleanup()
+    archive.pool.closeAll()
+    payload.zstdCleanup()
@@ -6,6 +6,7 @@ import copy
 from struct import unpack,pack
 import shutil
 import pickle
+import threading
 from dbo import Guid
 import res
 import sbr
@@ -14,17 +15,34 @@ def unpackLE(typ,data): return unpack("<"+typ,data)
 def unpackBE(typ,data): return unpack(">"+typ,data)
 
 guidTable=dict()
-parsedEbx=list()
+parsedEbx=set()
+ebxInfo=dict() #path -> readEbxGuid result of the files parsed so far
+ebxInfoLock=threading.Lock()
 
-def addEbxGuid(path,ebxRoot):
+def readEbxGuid(path,ebxRoot):
+    #Return EBX GUID and name.
+    #Only parse primary instance since we just need Name field and there are some enormous EBX files.
+    dbx=Dbx(path,ebxRoot,True)
+    return dbx.fileGUID, dbx.trueFilename
+
+def getEbxGuid(path,ebxRoot):
+    #readEbxGuid, but every file is only parsed once. The same EBX is listed in many bundles and some are enormous.
+    with ebxInfoLock:
+        info=ebxInfo.get(path)
+    if info is None:
+        info=readEbxGuid(path,ebxRoot)
+        with ebxInfoLock:
+            info=ebxInfo.setdefault(path,info)
+    return info
+
+def addEbxGuid(path,ebxRoot,info=None):
+    #Add EBX GUID and name to the database, info is readEbxGuid result if the file has been parsed already.
     if path in parsedEbx:
         return
 
-    #Add EBX GUID and name to the database.
-    #Only parse primary instance since we just need Name field and there are some enormous EBX files.
-    dbx=Dbx(path,ebxRoot,True)
-    guidTable[dbx.fileGUID]=dbx.trueFilename
-    parsedEbx.append(path)
+    guid, name = info if info else readEbxGuid(path,ebxRoot)
+    guidTable[guid]=name
+    parsedEbx.add(path)
 
 def writeGuidTable(dumpFolder):
     f=open(os.path.join(dumpFolder,"guidTable.bin"),"wb")
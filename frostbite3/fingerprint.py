@@ -0,0 +1,61 @@
+#Fingerprints of the TOCs, bundles and TOC chunks of the last dump, so an incremental dump after a game update
+#only extracts what has been added or changed. Stored in the target directory as a dict:
+#    tocPath -> [fileStats, missingPayloads, {bundleId: digest}, {chunk digests}, {targetPath: bundleId}]
+#fileStats are sizes and modification times of the TOC and its superbundle(s), a TOC whose files didn't change is skipped
+#without reading it unless some of its payloads were missing from the cats last time (e.g. localizations not installed).
+#The last dict has the bundle which wrote each file (None for TOC chunks), a file is only written again when its owner changes.
+import os
+import pickle
+import hashlib
+
+previous=dict()
+current=dict()
+ownerTocs=None #targetPath -> first TOC that owned it in the last dump, made from previous when needed
+
+def getPath(outPath):
+    return os.path.join(outPath,"fingerprints.bin")
+
+def load(outPath):
+    path=getPath(outPath)
+    if not os.path.isfile(path): return
+    f=open(path,"rb")
+    for tocPath, record in pickle.load(f).items():
+        if len(record)==5: #older fingerprints don't know the owners of files, their TOCs are dumped again
+            previous[tocPath]=record
+    f.close()
+
+def save(outPath):
+    path=getPath(outPath)
+    tmpPath=path+".tmp"
+    f=open(tmpPath,"wb")
+    pickle.dump(current,f)
+    f.close()
+    os.replace(tmpPath,path)
+
+def findOwnerTocs(records):
+    #Return targetPath -> first TOC that owns it, for previous or current.
+    owners=dict()
+    for tocPath, record in records.items():
+        for path in record[4]:
+            owners.setdefault(path,tocPath)
+    return owners
+
+def getOwnerToc(targetPath):
+    global ownerTocs
+    if ownerTocs is None:
+        ownerTocs=findOwnerTocs(previous)
+    return ownerTocs.get(targetPath)
+
+def statFiles(*paths):
+    stats=list()
+    for path in paths:
+        if path and os.path.isfile(path):
+            st=os.stat(path)
+            stats.append((st.st_size,st.st_mtime_ns))
+        else:
+            stats.append(None)
+    return tuple(stats)
+
+def digest(values):
+    #repr of plain values (strings, numbers, bytes, tuples) is stable between runs, pickle output is not.
+    return hashlib.sha1(repr(values).encode()).digest()
@@ -0,0 +1,121 @@
+#Journal of finished work kept in the target directory so an interrupted dump can be resumed.
+#Every process appends pickled records to its own file, a record is only written once the work it describes is on disk:
+#    ("payload", targetPath, sha1, size)
+#    ("bundle", bundleKey, resRows, ebxRows, paths)    resRows are addToResTable arguments, ebxRows are (path, guid, name),
+#                                                     paths are the files the bundle can extract (see dumper.selectTasks)
+#    ("toc", tocPath, bundleKeys, fingerprintRecord)
+#When resuming, finished TOCs and bundles are skipped without reading them and their RES/EBX table entries and fingerprints come from the journal.
+#Payloads are written to a temporary folder first (see payload.tempPath), the files left there by an interrupted dump are removed.
+#The files of a TOC are flushed to disk before its record is, so a power loss can't leave a TOC marked as done with files missing.
+import payload
+import os
+import pickle
+import threading
+import time
+
+#Filled from the journal files of the previous run when resuming.
+payloads=dict() #targetPath -> size
+bundles=dict() #bundleKey -> (resRows, ebxRows, paths)
+tocs=dict() #tocPath -> (bundleKeys, fingerprintRecord)
+
+journalDir=None
+unsyncedPaths=list() #payloads written by this process since the last TOC record
+journalFile=None
+lock=threading.Lock()
+
+def getDir(outPath):
+    return os.path.join(outPath,"journal")
+
+def getTempDir(outPath):
+    return os.path.join(outPath,"tmp")
+
+def clear(outPath):
+    #Start over, the journal and temporary files of an earlier run don't apply anymore. Also done once the dump is complete.
+    removeFiles(getDir(outPath),".bin")
+    removeFiles(getTempDir(outPath),".tmp")
+
+def removeFiles(path,ext):
+    #Remove the files with the extension from a folder and the folder itself if nothing else is left.
+    if not os.path.isdir(path): return
+    for fname in os.listdir(path):
+        if fname[-4:]==ext:
+            os.remove(os.path.join(path,fname))
+    if not os.listdir(path):
+        os.rmdir(path)
+
+def start(outPath,resume,mainProcess=True):
+    #Only the main process cleans up, the workers start while files are being written.
+    global journalDir
+    journalDir=getDir(outPath)
+    if resume and os.path.isdir(journalDir):
+        for fname in sorted(os.listdir(journalDir)):
+            if fname[-4:]==".bin":
+                load(os.path.join(journalDir,fname))
+    if resume and mainProcess:
+        removeFiles(getTempDir(outPath),".tmp")
+
+def load(path):
+    f=open(path,"rb")
+    while 1:
+        try:
+            record=pickle.load(f)
+        except Exception:
+            break #end of file or the last record was cut short by a crash
+
+        if record[0]=="payload":
+            payloads[record[1]]=record[3]
+        elif record[0]=="bundle":
+            bundles[record[1]]=record[2], record[3], record[4]
+        elif record[0]=="toc":
+            tocs[record[1]]=record[2], record[3]
+    f.close()
+
+def write(record,sync=False):
+    global journalFile
+    with lock:
+        if not journalFile:
+            #A new file for every run so records are never appended after a broken one.
+            os.makedirs(journalDir,exist_ok=True)
+            journalFile=open(os.path.join(journalDir,"%d.%d.bin" % (time.time()*1000,os.getpid())),"ab")
+
+        pickle.dump(record,journalFile)
+        journalFile.flush()
+        if sync:
+            os.fsync(journalFile.fileno())
+
+def addPayload(targetPath,sha1,size):
+    payloads[targetPath]=size
+    with lock:
+        unsyncedPaths.append(targetPath)
+    write(("payload",targetPath,sha1,size))
+
+def addBundle(bundleKey,resRows,ebxRows,paths):
+    write(("bundle",bundleKey,resRows,ebxRows,paths))
+
+def addToc(tocPath,bundleKeys,fingerprintRecord):
+    syncPayloads()
+    write(("toc",tocPath,bundleKeys,fingerprintRecord),True)
+
+def syncPayloads():
+    #Flush the payloads written since the last TOC to disk. One sync for everything is much faster than syncing every file,
+    #Windows doesn't have it though.
+    with lock:
+        paths=unsyncedPaths[:]
+        unsyncedPaths.clear()
+    if hasattr(os,"sync"):
+        os.sync()
+        return
+
+    for path in paths:
+        fd=os.open(payload.lp(path),os.O_RDWR|getattr(os,"O_BINARY",0))
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def close():
+    global journalFile
+    with lock:
+        if journalFile:
+            journalFile.close()
+            journalFile=None
@@ -0,0 +1,76 @@
+#Cache of parsed metadata (TOCs, cats, dal) kept in the target directory, so running the dumper again (resuming, incremental dumps,
+#different options) doesn't decrypt and parse all of it again. Every file is cached in its own pickle named after the kind of data
+#and the path, along with the size and modification time of the files it was read from. The cached data is only used while these match.
+import os
+import pickle
+import hashlib
+import threading
+
+cacheDir=None #no caching if None
+version=3 #change when the data returned by the parsers changes, older cache files are ignored then
+hits=0
+misses=0
+lock=threading.Lock()
+
+def getDir(outPath):
+    return os.path.join(outPath,"metadata")
+
+def start(outPath):
+    global cacheDir
+    cacheDir=getDir(outPath)
+
+def getPath(kind,path):
+    name=hashlib.sha1(("%d\0%s\0%s" % (version,kind,os.path.abspath(path))).encode()).hexdigest()
+    return os.path.join(cacheDir,name+".bin")
+
+def statFile(path):
+    st=os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def get(kind,path):
+    #Return the cached data or None.
+    global hits, misses
+    if not cacheDir: return None
+    try:
+        f=open(getPath(kind,path),"rb")
+        try:
+            stats, value = pickle.load(f)
+        finally:
+            f.close()
+        for statPath, stat in stats:
+            if statFile(statPath)!=stat: value=None
+    except Exception:
+        value=None #not cached yet, a file is gone or the cache file is broken
+
+    with lock:
+        if value is None: misses+=1
+        else: hits+=1
+    return value
+
+def put(kind,path,value,otherPaths=()):
+    #Cache data read from path and otherPaths.
+    if not cacheDir: return
+    stats=[(statPath,statFile(statPath)) for statPath in (path,)+tuple(otherPaths)]
+    os.makedirs(cacheDir,exist_ok=True)
+    cachePath=getPath(kind,path)
+    tmpPath="%s.%d.%d.tmp" % (cachePath,os.getpid(),threading.get_ident())
+    f=open(tmpPath,"wb")
+    pickle.dump((stats,value),f,pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.replace(tmpPath,cachePath)
+
+def cached(kind,path,load):
+    #Return load(path), from the cache if possible.
+    value=get(kind,path)
+    if value is None:
+        value=load(path)
+        put(kind,path,value)
+    return value
+
+def takeStats():
+    #Return (hits, misses) since the last call and reset them.
+    global hits, misses
+    with lock:
+        stats=hits, misses
+        hits=misses=0
+        return stats
@@ -1,27 +1,22 @@
 import cas
+import codec
+import archive
+import journal
 import os
-import io
+import struct
 from struct import pack,unpack
 import ctypes
-import zlib
-
-liblz4 = ctypes.cdll.LoadLibrary(r"..\thirdparty\liblz4")
-libzstd = ctypes.cdll.LoadLibrary(r"..\thirdparty\libzstd")
-try: oodle = ctypes.windll.LoadLibrary(r"..\thirdparty\oo2core_4_win64")
-except: oodle = None
-
-liblz4.LZ4_decompress_safe_partial.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int32,ctypes.c_int32,ctypes.c_int32]
-libzstd.ZSTD_createDDict.restype=ctypes.c_void_p
-libzstd.ZSTD_createDDict.argtypes=[ctypes.c_void_p,ctypes.c_size_t]
-libzstd.ZSTD_freeDDict.argtypes=[ctypes.c_void_p]
-libzstd.ZSTD_createDCtx.restype=ctypes.c_void_p
-libzstd.ZSTD_decompress_usingDDict.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p]
-libzstd.ZSTD_freeDCtx.argtypes=[ctypes.c_void_p]
-libzstd.ZSTD_decompress.argtypes=[ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p,ctypes.c_size_t]
-if oodle: oodle.OodleLZ_Decompress.argtypes=[ctypes.c_void_p,ctypes.c_size_t,ctypes.c_void_p,ctypes.c_size_t,
-                                  ctypes.c_int,ctypes.c_int,ctypes.c_int,
-                                  ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,
-                                  ctypes.c_int]
+import threading
+import itertools
+import concurrent.futures
+import collections
+import weakref
+import mmap
+import shutil
+try:
+    import fcntl
+except ImportError:
+    fcntl=None #Windows
 
 
 
@@ -38,7 +33,103 @@ def lp(path): #long pathnames
     if path[:4]=='\\\\?\\' or path=="" or len(path)<=247: return path
     return '\\\\?\\' + os.path.normpath(path)
 
-
+#Folder for the temporary files (see journal.getTempDir), so the ones left by an interrupted dump can be found without
+#searching the whole dump. They're put next to their files if it's None.
+tempDir=None
+tempNumbers=itertools.count()
+
+def tempPath(path):
+    #Payloads are written under a temporary name first so other processes and threads never see a partially written file.
+    if tempDir:
+        return os.path.join(tempDir,"%d.%d.%d.tmp" % (os.getpid(),threading.get_ident(),next(tempNumbers)))
+    return "%s.%d.%d.tmp" % (path,os.getpid(),threading.get_ident())
+
+def commitFile(tmpPath,path,overwrite=False):
+    #Move a finished file in place. Unless overwrite is set, a file that's there already is kept, so the first process or thread
+    #to extract it wins rather than the last one: a hard link (a rename on Windows) fails if the file exists, unlike os.replace.
+    #Files left by an earlier dump are still replaced when refreshing them.
+    try:
+        if tempDir: makeLongDirs(path)
+        if overwrite:
+            os.replace(lp(tmpPath),lp(path))
+            return
+
+        if isStale(path):
+            try:
+                os.remove(lp(path))
+            except FileNotFoundError:
+                pass
+
+        if os.name=="nt":
+            os.rename(lp(tmpPath),lp(path))
+        else:
+            os.link(lp(tmpPath),lp(path))
+            os.remove(lp(tmpPath))
+    except FileExistsError:
+        #Another process or thread has extracted the same file in the meantime.
+        os.remove(lp(tmpPath))
+    except OSError:
+        if os.path.isfile(lp(tmpPath)): os.remove(lp(tmpPath))
+        raise
+
+
+
+class DecompressionContext:
+    """Decompression state owned by a single thread: long-lived backend state (e.g. Zstd context) and reusable source/destination buffers.
+
+    Data returned by a context is only valid until the next block is decompressed with it."""
+    def __init__(self):
+        self.states=dict()
+        self.srcBuf=ctypes.create_string_buffer(0x10000)
+        self.dstBuf=ctypes.create_string_buffer(0x10000)
+        self.patchBuf=ctypes.create_string_buffer(0x10000)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for backend, state in self.states.items():
+            backend.freeState(state)
+        self.states.clear()
+
+    def getState(self,backend):
+        if backend not in self.states:
+            self.states[backend]=backend.newState()
+        return self.states[backend]
+
+    def read(self,f,size):
+        if len(self.srcBuf)<size: self.srcBuf=ctypes.create_string_buffer(size)
+        view=memoryview(self.srcBuf).cast("B")[:size]
+        f.readinto(view)
+        return view
+
+    def getDstBuf(self,size):
+        if len(self.dstBuf)<size: self.dstBuf=ctypes.create_string_buffer(size)
+        return self.dstBuf
+
+    def getPatchBuf(self,size):
+        if len(self.patchBuf)<size: self.patchBuf=ctypes.create_string_buffer(size)
+        return self.patchBuf
+
+threadContexts=threading.local()
+allContexts=weakref.WeakSet()
+allContextsLock=threading.Lock()
+
+def getContext():
+    #Each thread lazily creates its own context and keeps it until zstdCleanup.
+    ctx=getattr(threadContexts,"ctx",None)
+    if not ctx:
+        ctx=DecompressionContext()
+        threadContexts.ctx=ctx
+        with allContextsLock:
+            allContexts.add(ctx)
+    return ctx
 
 def readBlockHeader(f):
     #Block header is a bitfield:
@@ -47,7 +138,7 @@ def readBlockHeader(f):
     #8 bits: compression type
     #4 bits: always 7?
     #20 bits: compressed size
-    num1, num2 = unpack(">II",f.read(8))
+    num1, num2 = archive.unpackFrom(f,">II")
     dictFlag=num1&0xFF000000
     uncompressedSize=num1&0x00FFFFFF
     comType=(num2&0xFF000000)>>24
@@ -55,114 +146,382 @@ def readBlockHeader(f):
     compressedSize=num2&0x000FFFFF
     return dictFlag, uncompressedSize, comType, typeFlag, compressedSize
 
-def decompressBlock(f,f2):
+def readBlock(f,ctx=None):
+    #Read the header and the compressed data of the next block. If a context is given, the data is read into its source buffer.
+    #Mapped archives return a view into the map instead.
     dictFlag, uncompressedSize, comType, typeFlag, compressedSize = readBlockHeader(f)
 
     #Hack for legacy format in NFS:R prototype.
     if typeFlag==0:
         comType=0x02 if uncompressedSize!=compressedSize else 0x00
 
-    if comType==0x09:
-        #Block is compressed with LZ4.
-        srcBuf=f.read(compressedSize)
-        dstBuf=bytes(uncompressedSize)
-        liblz4.LZ4_decompress_safe_partial(srcBuf,dstBuf,compressedSize,uncompressedSize,uncompressedSize)
-        f2.write(dstBuf)
-    elif comType==0x0f:
-        #Block is compressed with Zstd.
-        srcBuf=f.read(compressedSize)
-        dstBuf=bytes(uncompressedSize)
-        if dictFlag:
-            zstd_dctx=ctypes.c_void_p(libzstd.ZSTD_createDCtx())
-            libzstd.ZSTD_decompress_usingDDict(zstd_dctx,dstBuf,uncompressedSize,srcBuf,compressedSize,zstd_dict)
-            libzstd.ZSTD_freeDCtx(zstd_dctx)
-        else:
-            libzstd.ZSTD_decompress(dstBuf,uncompressedSize,srcBuf,compressedSize)
-        f2.write(dstBuf)
-    elif comType==0x15:
-        #Block is compressed with Oodle. Only used in FIFA 18/19 so far.
-        if not oodle: raise Exception("You need oo2core_4_win64.dll to decompress Oodle v4.")
-        srcBuf=f.read(compressedSize)
-        dstBuf=bytes(uncompressedSize)
-        oodle.OodleLZ_Decompress(srcBuf,compressedSize,dstBuf,uncompressedSize,0,0,0,0,0,0,0,0,0,3)
-        f2.write(dstBuf)
-    elif comType==0x02:
-        #Block is compressed with zlib.
-        srcBuf=f.read(compressedSize)
-        dstBuf=zlib.decompress(srcBuf)
-        f2.write(dstBuf)
-    elif comType==0x00:
-        #No compression, just write this block as it is.
-        f2.write(f.read(compressedSize))
-    else:
+    if comType not in codec.comTypeNames:
         raise Exception("Unknown compression type 0x%02x at 0x%08x in %s" % (comType,f.tell()-8,f.name))
 
+    if isinstance(f,archive.MappedReader):
+        return dictFlag, uncompressedSize, comType, f.readView(compressedSize)
+    if ctx:
+        return dictFlag, uncompressedSize, comType, ctx.read(f,compressedSize)
+    return dictFlag, uncompressedSize, comType, f.read(compressedSize)
+
+def decodeBlock(dictFlag,uncompressedSize,comType,srcBuf,ctx,dstBuf=None):
+    #Decompress a single block and return its data. Doesn't touch any files so it can run in any thread.
+    #The data goes into dstBuf (ctypes array of uncompressedSize bytes) if given, or into the context's buffer otherwise.
+    backend=codec.getBackend(comType)
+    target=ctx.getDstBuf(uncompressedSize) if dstBuf is None else dstBuf
+    data=backend.decompress(srcBuf,uncompressedSize,target,dictFlag,ctx.getState(backend))
+
+    if data is target:
+        return memoryview(target).cast("B")[:uncompressedSize]
+    if dstBuf is not None:
+        memoryview(dstBuf).cast("B")[:len(data)]=data
+    return data
+
+def decodeBlockCopy(dictFlag,uncompressedSize,comType,srcBuf):
+    #Same as decodeBlock but the result stays valid after the thread's context is reused.
+    return bytes(decodeBlock(dictFlag,uncompressedSize,comType,srcBuf,getContext()))
+
+#Many payloads are patched against the same base blocks (e.g. several versions of a chunk in patched cas bundles).
+#Decompressed base blocks are kept in an LRU cache of up to baseBlockCacheSize bytes per process, 0 disables it.
+baseBlockCacheSize=64*1024*1024
+
+class BlockCache:
+    def __init__(self):
+        self.blocks=collections.OrderedDict() #(archive path, block offset) -> (data, end offset of the block), least recently used first
+        self.size=0
+        self.lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+
+    def get(self,key):
+        with self.lock:
+            block=self.blocks.get(key)
+            if block:
+                self.blocks.move_to_end(key)
+                self.hits+=1
+            else:
+                self.misses+=1
+            return block
+
+    def add(self,key,data,endOffset):
+        with self.lock:
+            if key in self.blocks: return
+            self.blocks[key]=data, endOffset
+            self.size+=len(data)
+            while self.size>baseBlockCacheSize:
+                oldKey, (oldData, oldEnd) = self.blocks.popitem(last=False)
+                self.size-=len(oldData)
+
+    def takeStats(self):
+        #Return (hits, misses) since the last call and reset them.
+        with self.lock:
+            stats=self.hits, self.misses
+            self.hits=self.misses=0
+            return stats
+
+baseBlocks=BlockCache()
+
+def decompressBaseBlock(f,ctx):
+    #Decompress a base block and return its data, from the cache if it has been decompressed before.
+    #Without the cache the data is a view of the context's patch buffer, valid until the next base block.
+    #Delta blocks decompressed in the meantime use the other buffers.
+    path=getattr(f,"name",None)
+    offset=f.tell()
+    if baseBlockCacheSize and path:
+        block=baseBlocks.get((path,offset))
+        if block:
+            f.seek(block[1])
+            return block[0]
+
+    dictFlag, uncompressedSize, comType, srcBuf = readBlock(f,ctx)
+    dstBuf=ctx.getPatchBuf(uncompressedSize)
+    decodeBlock(dictFlag,uncompressedSize,comType,srcBuf,ctx,dstBuf)
+    data=memoryview(dstBuf).cast("B")[:uncompressedSize]
+    if baseBlockCacheSize and path:
+        data=data.tobytes()
+        baseBlocks.add((path,offset),data,f.tell())
+    return data
+
+def copyBaseBlock(f,f2,ctx):
+    #Add a base block without modification. Only compressed blocks the output keeps go through the cache,
+    #others go straight into the output as there's no decompression to save.
+    if baseBlockCacheSize:
+        pos=f.tell()
+        dictFlag, uncompressedSize, comType, typeFlag, compressedSize = readBlockHeader(f)
+        f.seek(pos)
+        if comType!=0x00 and (not isinstance(f2,BundleOutput) or f2.keeps(uncompressedSize)):
+            f2.write(decompressBaseBlock(f,ctx))
+            return
+    decompressBlock(f,f2)
+
+def decompressBlock(f,f2):
+    ctx=getContext()
+    dictFlag, uncompressedSize, comType, srcBuf = readBlock(f,ctx)
+    if isinstance(f2,BundleOutput):
+        return f2.decompressBlock(dictFlag,uncompressedSize,comType,srcBuf,ctx)
+    if isinstance(f2,PayloadOutput):
+        f2.decodeAt(f2.reserve(uncompressedSize),dictFlag,uncompressedSize,comType,srcBuf,ctx)
+    else:
+        f2.write(decodeBlock(dictFlag,uncompressedSize,comType,srcBuf,ctx))
     return uncompressedSize
 
+#Outputs at least this big are memory mapped instead of being assembled in memory.
+minMappedOutputSize=16*1024*1024
+
+class PayloadOutput:
+    """Output file of a known size, blocks are decompressed straight into one preallocated buffer and written with a single call.
+
+    Supports write() and tell() like a regular file. Grows if the payload turns out to be bigger than expected."""
+    def __init__(self,path,size):
+        self.f=open2(path,"w+b")
+        self.pos=0
+        if size>=minMappedOutputSize:
+            self.f.truncate(size)
+            self.buf=mmap.mmap(self.f.fileno(),size)
+        else:
+            self.buf=bytearray(size)
+
+    def fits(self,size):
+        return self.pos+size<=len(self.buf)
+
+    def reserve(self,size):
+        #Return the offset where the next size bytes go. Nobody may be decoding into the buffer when it grows.
+        if not self.fits(size):
+            if isinstance(self.buf,mmap.mmap):
+                self.f.truncate(self.pos+size)
+                self.buf.resize(self.pos+size)
+            else:
+                self.buf.extend(bytes(self.pos+size-len(self.buf)))
+        offset=self.pos
+        self.pos+=size
+        return offset
+
+    def decodeAt(self,offset,dictFlag,uncompressedSize,comType,srcBuf,ctx=None):
+        dstBuf=(ctypes.c_char*uncompressedSize).from_buffer(self.buf,offset)
+        decodeBlock(dictFlag,uncompressedSize,comType,srcBuf,ctx or getContext(),dstBuf)
+        del dstBuf #release the buffer export so the map can be resized or closed
+
+    def write(self,data):
+        size=len(data)
+        offset=self.reserve(size)
+        self.buf[offset:offset+size]=data
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if isinstance(self.buf,mmap.mmap):
+            self.buf.close()
+            self.f.truncate(self.pos)
+        else:
+            self.f.write(memoryview(self.buf)[:self.pos])
+        self.f.close()
+
+class BundleOutput:
+    """Output for the payloads of a noncas bundle which are stored back to back. Data is split between the payloads
+    by their sizes as it comes in and each payload is committed once it's complete.
+
+    payloads are (targetPath, originalSize) in bundle order, blocks of payloads without a path are not decompressed."""
+    def __init__(self,payloads):
+        self.payloads=payloads
+        self.index=-1
+        self.pos=0
+        self.end=0
+        self.f2=None
+        self.tmpPath=None
+        self.nextPayload()
+
+    def nextPayload(self):
+        #Move on to the next payload that still needs data. Empty payloads are written right away.
+        while self.end is not None and self.pos==self.end:
+            if self.f2:
+                self.f2.close()
+                commitFile(self.tmpPath,self.payloads[self.index][0])
+                self.f2=None
+
+            self.index+=1
+            if self.index==len(self.payloads):
+                self.end=None
+                break
+
+            targetPath, originalSize = self.payloads[self.index]
+            if targetPath:
+                self.tmpPath=tempPath(targetPath)
+                self.f2=PayloadOutput(self.tmpPath,originalSize)
+            self.end=self.pos+originalSize
+
+    def decompressBlock(self,dictFlag,uncompressedSize,comType,srcBuf,ctx):
+        if self.end is not None and self.pos+uncompressedSize<=self.end:
+            if self.f2:
+                self.f2.decodeAt(self.f2.reserve(uncompressedSize),dictFlag,uncompressedSize,comType,srcBuf,ctx)
+            self.pos+=uncompressedSize
+            self.nextPayload()
+        else:
+            self.write(decodeBlock(dictFlag,uncompressedSize,comType,srcBuf,ctx)) #block spans several payloads
+        return uncompressedSize
+
+    def keeps(self,size):
+        #Return True if any of the next size bytes go to a payload that is written.
+        if self.f2: return True
+        start=self.end
+        index=self.index+1
+        while start is not None and start<self.pos+size and index<len(self.payloads):
+            targetPath, originalSize = self.payloads[index]
+            if targetPath and originalSize: return True
+            start+=originalSize
+            index+=1
+        return False
+
+    def write(self,data):
+        data=memoryview(data).cast("B")
+        while len(data):
+            if self.end is None: raise Exception("Noncas bundle payload data goes past the last entry")
+            size=min(len(data),self.end-self.pos)
+            if self.f2: self.f2.write(data[:size])
+            self.pos+=size
+            data=data[size:]
+            self.nextPayload()
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        #Only a payload that didn't get all of its data is left open.
+        if self.f2:
+            self.f2.close()
+            os.remove(lp(self.tmpPath))
+            self.f2=None
+
+#Payloads at least this big have their blocks decompressed by several threads at once.
+minParallelPayloadSize=4*1024*1024
+numBlockThreads=1
+blockPool=None
+blockPoolLock=threading.Lock()
+
+def getBlockPool():
+    global blockPool
+    with blockPoolLock:
+        if not blockPool:
+            blockPool=concurrent.futures.ThreadPoolExecutor(numBlockThreads)
+    return blockPool
+
 def decompressPayload(srcPath,offset,size,originalSize,outPath):
-    f=open(srcPath,"rb")
+    f=archive.openFile(srcPath)
     f.seek(offset)
-    f2=open2(outPath,"wb")
+    tmpPath=tempPath(outPath)
+    if originalSize:
+        f2=PayloadOutput(tmpPath,originalSize)
+    else:
+        f2=open2(tmpPath,"wb")
 
     #Payloads are split into blocks and each block may or may not be compressed.
     #We need to decompress and glue the blocks together to get the real file.
-    while f.tell()!=offset+size:
-        decompressBlock(f,f2)
-        if originalSize and f2.tell()==originalSize:
-            break
+    if numBlockThreads>1 and size>=minParallelPayloadSize:
+        decompressBlocksParallel(f,offset+size,originalSize,f2)
+    else:
+        while f.tell()!=offset+size:
+            decompressBlock(f,f2)
+            if originalSize and f2.tell()==originalSize:
+                break
 
+    complete=f.tell()==offset+size #False if the payload was cut short at originalSize
     f.close()
     f2.close()
+    commitFile(tmpPath,outPath)
+    return complete
+
+def decompressBlocksParallel(f,endOffset,originalSize,f2):
+    #Blocks don't depend on each other so read them in order and hand them over to the block pool.
+    #The sizes in block headers tell where each block ends up in the output. With a preallocated output
+    #the threads decompress right into it, otherwise results are written in order. Only a limited number
+    #of blocks is in flight to keep the memory usage in check.
+    pool=getBlockPool()
+    pending=collections.deque()
+    preallocated=isinstance(f2,PayloadOutput)
+    currentSize=0
+    while f.tell()!=endOffset:
+        dictFlag, uncompressedSize, comType, srcBuf = readBlock(f)
+        if preallocated:
+            if not f2.fits(uncompressedSize):
+                while pending: pending.popleft().result()
+            offset=f2.reserve(uncompressedSize)
+            pending.append(pool.submit(f2.decodeAt,offset,dictFlag,uncompressedSize,comType,srcBuf))
+        else:
+            pending.append(pool.submit(decodeBlockCopy,dictFlag,uncompressedSize,comType,srcBuf))
+
+        if len(pending)>=numBlockThreads*4:
+            data=pending.popleft().result()
+            if not preallocated: f2.write(data)
+
+        currentSize+=uncompressedSize
+        if originalSize and currentSize==originalSize:
+            break
+
+    while pending:
+        data=pending.popleft().result()
+        if not preallocated: f2.write(data)
 
 def split1v7(num): return (num>>28,num&0x0fffffff) #0x7A945CF1 => (7, 0xA945CF1)
 
-def decompressPatchedPayload(basePath,baseOffset,deltaPath,deltaOffset,deltaSize,originalSize,outPath,midInstructionType=-1,midInstructionSize=0):
-    base=open(basePath,"rb")
-    delta=open(deltaPath,"rb")
+def decompressPatchedPayload(basePath,baseOffset,deltaPath,deltaOffset,deltaSize,originalSize,outPath):
+    base=archive.openFile(basePath)
+    delta=archive.openFile(deltaPath)
     base.seek(baseOffset)
     delta.seek(deltaOffset)
-    f2=open2(outPath,"wb")
+    tmpPath=tempPath(outPath)
+    f2=PayloadOutput(tmpPath,originalSize)
+    patchPayload(base,delta,deltaOffset+deltaSize,originalSize,f2)
+    base.close()
+    delta.close()
+    f2.close()
+    commitFile(tmpPath,outPath)
 
-    instructionType=midInstructionType
-    instructionSize=midInstructionSize
+unpackFix=struct.Struct(">HBB").unpack_from
 
+def patchPayload(base,delta,deltaEnd,originalSize,f2):
+    #Run the delta instructions from the current delta position until deltaEnd and write originalSize bytes to f2.
     #This is where magic happens: we need to splice bits from delta bundle and base bundle.
     #See here for details: https://pastebin.com/TftZEU9q
-    while delta.tell()!=deltaOffset+deltaSize:
-        if instructionType==-1:
-            instructionType, instructionSize = split1v7(unpack(">I",delta.read(4))[0])
+    ctx=getContext()
+    while delta.tell()!=deltaEnd:
+        instructionType, instructionSize = split1v7(unpack(">I",delta.read(4))[0])
 
         if instructionType==0: #add base blocks without modification
             for i in range(instructionSize):
-                decompressBlock(base,f2)
+                copyBaseBlock(base,f2,ctx)
                 if f2.tell()==originalSize: break
         elif instructionType==2: #make tiny fixes in the base block
             blockSize=unpack(">H",delta.read(2))[0]+1
-            deltaBlockEnd=delta.tell()+instructionSize
-
-            baseBlock=io.BytesIO()
-            baseBlockSize=decompressBlock(base,baseBlock)
-            baseBlock.seek(0)
-
-            while delta.tell()!=deltaBlockEnd:
-                baseRead,baseSkip,addCount=unpack(">HBB",delta.read(4))
-                f2.write(baseBlock.read(baseRead-baseBlock.tell()))
-                baseBlock.seek(baseSkip,1)
-                f2.write(delta.read(addCount))
-
-            f2.write(baseBlock.read(baseBlockSize-baseBlock.tell()))
+            fixes=delta.read(instructionSize) #(baseRead, baseSkip, addCount) followed by addCount bytes, repeated
+            baseBlock=bytes(decompressBaseBlock(base,ctx)) #bytes slice faster than views, there can be hundreds of fixes
+
+            #Collect the pieces and write the fixed block in one go.
+            parts=list()
+            append=parts.append
+            pos=0
+            fixPos=0
+            while fixPos<len(fixes):
+                baseRead,baseSkip,addCount=unpackFix(fixes,fixPos)
+                fixPos+=4
+                append(baseBlock[pos:baseRead])
+                if addCount:
+                    append(fixes[fixPos:fixPos+addCount])
+                    fixPos+=addCount
+                pos=baseRead+baseSkip
+
+            append(baseBlock[pos:])
+            f2.write(b"".join(parts))
         elif instructionType==1: #make larger fixes in the base block
-            baseBlock=io.BytesIO()
-            baseBlockSize=decompressBlock(base,baseBlock)
-            baseBlock.seek(0)
+            baseBlock=memoryview(decompressBaseBlock(base,ctx))
+            pos=0
 
             for i in range(instructionSize):
                 baseRead,baseSkip=unpack(">HH",delta.read(4))
-                f2.write(baseBlock.read(baseRead-baseBlock.tell()))
-                baseBlock.seek(baseSkip,1)
+                f2.write(baseBlock[pos:baseRead])
+                pos=baseRead+baseSkip
                 decompressBlock(delta,f2)
 
-            f2.write(baseBlock.read(baseBlockSize-baseBlock.tell()))
+            f2.write(baseBlock[pos:])
         elif instructionType==3: #add delta blocks directly to the payload
             for i in range(instructionSize):
                 decompressBlock(delta,f2)
@@ -174,20 +533,155 @@ def decompressPatchedPayload(basePath,baseOffset,deltaPath,deltaOffset,deltaSize
         else:
             raise Exception("Unknown payload type: 0x%02x Delta offset: 0x%08x" % (instructionType,delta.tell()-4))
 
-        instructionType=-1
         if f2.tell()==originalSize: break
 
     #May need to get the rest from the base bundle (infinite type 0 instructions).
     while f2.tell()!=originalSize:
-        decompressBlock(base,f2)
+        copyBaseBlock(base,f2,ctx)
+
+#The same payload is often listed under several names (e.g. a chunk both in a toc and in a bundle).
+#Remember where each payload was extracted to and copy that file instead of decompressing it again.
+#Keyed by (sha1, originalSize) since chunks may be cut short in bundles.
+#A payload is reserved while it's being extracted so other threads wait for it and copy it rather than decompress it at the same time.
+extractedPayloads=dict()
+extractedPayloadsLock=threading.Lock()
+reusedPayloads=0
+reusedBytes=0
+
+#Hardlink duplicates instead of copying them when the file system can't clone files. Saves disk space
+#but editing one of the files changes all of them.
+linkDuplicates=False
+
+FICLONE=0x40049409 #Linux ioctl to share the data of two files on Btrfs/XFS
+
+def cloneFile(srcPath,targetPath):
+    tmpPath=tempPath(targetPath)
+    makeLongDirs(targetPath)
+    try:
+        if linkDuplicates:
+            try:
+                os.link(lp(srcPath),lp(tmpPath))
+                commitFile(tmpPath,targetPath)
+                return
+            except OSError:
+                pass
+
+        src=open(lp(srcPath),"rb")
+        dst=open(lp(tmpPath),"wb")
+        try:
+            if not fcntl: raise OSError()
+            fcntl.ioctl(dst.fileno(),FICLONE,src.fileno())
+        except OSError:
+            shutil.copyfileobj(src,dst,0x100000)
+        src.close()
+        dst.close()
+    except OSError:
+        if os.path.isfile(lp(tmpPath)): os.remove(lp(tmpPath))
+        raise
+    commitFile(tmpPath,targetPath)
+
+class PendingPayload:
+    #Stands in for a payload while a thread extracts it, threads wanting the same payload wait for it instead of decompressing it too.
+    def __init__(self):
+        self.owner=threading.get_ident()
+        self.done=threading.Event()
+        self.path=None #where it was extracted to, stays None if the extraction failed
+
+def reusePayload(key,targetPath):
+    #Return True if a payload with this key has been extracted already and got copied to targetPath.
+    #Otherwise the key is reserved for the caller, who must extract the payload and call addExtractedPayload or releasePayload.
+    global reusedPayloads, reusedBytes
+    while True:
+        with extractedPayloadsLock:
+            srcPath=extractedPayloads.get(key)
+            if srcPath is None:
+                extractedPayloads[key]=PendingPayload()
+                return False
+
+        if isinstance(srcPath,PendingPayload):
+            srcPath.done.wait()
+            srcPath=srcPath.path
+            if not srcPath: continue #the other thread failed, try again
+
+        try:
+            cloneFile(srcPath,targetPath)
+            break
+        except OSError:
+            #The first file is gone, decompress it again.
+            with extractedPayloadsLock:
+                if extractedPayloads.get(key)==srcPath:
+                    extractedPayloads[key]=PendingPayload()
+                    return False
+
+    with extractedPayloadsLock:
+        reusedPayloads+=1
+        reusedBytes+=os.path.getsize(lp(targetPath))
+    return True
 
-    base.close()
-    delta.close()
-    f2.close()
+def addExtractedPayload(key,targetPath):
+    #Also wakes up the threads waiting for the payload.
+    with extractedPayloadsLock:
+        pending=extractedPayloads.get(key)
+        if pending is None or isinstance(pending,PendingPayload):
+            extractedPayloads[key]=targetPath
+    if isinstance(pending,PendingPayload):
+        pending.path=targetPath
+        pending.done.set()
+
+def releasePayload(key):
+    #Give up the reservation of a payload that couldn't be extracted, the next thread wanting it extracts it instead.
+    with extractedPayloadsLock:
+        pending=extractedPayloads.get(key)
+        if not isinstance(pending,PendingPayload) or pending.owner!=threading.get_ident(): return
+        del extractedPayloads[key]
+    pending.done.set()
+
+def takeReuseStats():
+    #Return (payloads reused, decompressed bytes avoided) since the last call and reset them.
+    global reusedPayloads, reusedBytes
+    with extractedPayloadsLock:
+        stats=reusedPayloads, reusedBytes
+        reusedPayloads=reusedBytes=0
+        return stats
+
+def extractCasPayload(sha1,originalSize,targetPath):
+    key=sha1, originalSize
+    if reusePayload(key,targetPath): return
+
+    try:
+        catEntry=cas.catDict[sha1]
+        complete=decompressPayload(catEntry.path,catEntry.offset,catEntry.size,originalSize,targetPath)
+    except:
+        releasePayload(key)
+        raise
+    addExtractedPayload(key,targetPath)
+
+    #Chunks in tocs don't know their size, they match any full payload with the same sha1.
+    if complete:
+        addExtractedPayload((sha1,None),targetPath)
+        addExtractedPayload((sha1,os.path.getsize(lp(targetPath))),targetPath)
+
+#Overwrite files left by an earlier dump instead of keeping them (incremental dumps).
+#Files last modified before dumpStartTime are from an earlier dump, newer ones were extracted by this one.
+refreshFiles=False
+dumpStartTime=0
+
+def isStale(path):
+    #Return True if path is a file of an earlier dump which is to be overwritten.
+    if not refreshFiles: return False
+    try:
+        return os.path.getmtime(lp(path))<dumpStartTime
+    except FileNotFoundError:
+        return False
+
+def isExtracted(targetPath):
+    #Files written by an interrupted dump are known from its journal, no need to check the disk for them.
+    if targetPath in journal.payloads: return True
+    return not refreshFiles and os.path.isfile(lp(targetPath))
 
 #for each bundle, the dump script selects one of these six functions
 def casBundlePayload(entry,targetPath,isChunk):
-    if os.path.isfile(lp(targetPath)): return True
+    if isExtracted(targetPath): return True
 
     #Some files may be from localizations user doesn't have installed.
     sha1=entry.get("sha1")
@@ -197,14 +691,13 @@ def casBundlePayload(entry,targetPath,isChunk):
         else:
             originalSize=entry.get("originalSize")
 
-        catEntry=cas.catDict[sha1]
-        decompressPayload(catEntry.path,catEntry.offset,catEntry.size,originalSize,targetPath)
+        extractCasPayload(sha1,originalSize,targetPath)
         return True
     else:
         return False
 
 def casPatchedBundlePayload(entry,targetPath,isChunk):
-    if os.path.isfile(lp(targetPath)): return True
+    if isExtracted(targetPath): return True
 
     if entry.get("casPatchType")==2:
         if isChunk:
@@ -212,55 +705,143 @@ def casPatchedBundlePayload(entry,targetPath,isChunk):
         else:
             originalSize=entry.get("originalSize")
 
-        catDelta=cas.catDict[entry.get("deltaSha1")]
-        catBase=cas.catDict[entry.get("baseSha1")]
-        decompressPatchedPayload(catBase.path,catBase.offset,
-                                 catDelta.path,catDelta.offset,catDelta.size,
-                                 originalSize,targetPath)
+        key=entry.get("baseSha1"), entry.get("deltaSha1"), originalSize
+        if reusePayload(key,targetPath): return True
+
+        try:
+            catDelta=cas.catDict[entry.get("deltaSha1")]
+            catBase=cas.catDict[entry.get("baseSha1")]
+            decompressPatchedPayload(catBase.path,catBase.offset,
+                                     catDelta.path,catDelta.offset,catDelta.size,
+                                     originalSize,targetPath)
+        except:
+            releasePayload(key)
+            raise
+        addExtractedPayload(key,targetPath)
         return True
     else:
         return casBundlePayload(entry, targetPath,isChunk) #if casPatchType is not 2, use the unpatched function.
 
 def casChunkPayload(entry,targetPath):
-    if os.path.isfile(lp(targetPath)): return True
+    if isExtracted(targetPath): return True
 
     #Some files may be from localizations user doesn't have installed.
     sha1=entry.get("sha1")
     if sha1 in cas.catDict:
-        catEntry=cas.catDict[entry.get("sha1")]
-        decompressPayload(catEntry.path,catEntry.offset,catEntry.size,None,targetPath)
+        extractCasPayload(sha1,None,targetPath)
         return True
     else:
         return False
 
-def noncasBundlePayload(entry,targetPath,sourcePath):
-    if os.path.isfile(lp(targetPath)): return True
-    decompressPayload(sourcePath,entry.offset,entry.size,entry.originalSize,targetPath)
+def skipBlocks(f,size):
+    #Move past the blocks holding the next size bytes of payload data without decompressing them.
+    currentSize=0
+    while currentSize<size:
+        dictFlag, uncompressedSize, comType, typeFlag, compressedSize = readBlockHeader(f)
+        f.seek(compressedSize,1)
+        currentSize+=uncompressedSize
+
+#Noncas payloads are stored back to back without any offsets, so all payloads of a bundle are extracted in one pass.
+#targetPaths has a path for each bundle entry (ebx, res, chunks) or None if the entry must not be written.
+def noncasBundlePayload(bundle,targetPaths,sourcePath):
+    f=archive.openFile(sourcePath)
+    try:
+        f.seek(bundle.payloadOffset)
+        for entry, targetPath in zip(bundle.entries,targetPaths):
+            if not targetPath or isExtracted(targetPath):
+                skipBlocks(f,entry.originalSize)
+                continue
+
+            tmpPath=tempPath(targetPath)
+            f2=PayloadOutput(tmpPath,entry.originalSize)
+            try:
+                if numBlockThreads>1 and entry.originalSize>=minParallelPayloadSize:
+                    decompressBlocksParallel(f,None,entry.originalSize,f2)
+                else:
+                    while f2.tell()<entry.originalSize:
+                        decompressBlock(f,f2)
+            except:
+                #Don't leave the partial payload behind.
+                f2.close()
+                os.remove(lp(tmpPath))
+                raise
+            f2.close()
+            commitFile(tmpPath,targetPath)
+    finally:
+        f.close()
     return True
 
-def noncasPatchedBundlePayload(entry,targetPath,sourcePath):
-    if os.path.isfile(lp(targetPath)): return True
-    decompressPatchedPayload(sourcePath[0], entry.baseOffset,#entry.baseSize,
-                            sourcePath[1], entry.deltaOffset, entry.deltaSize,
-                            entry.originalSize, targetPath,
-                            entry.midInstructionType, entry.midInstructionSize)
+def noncasPatchedBundlePayload(bundle,targetPaths,sourcePath):
+    #Entries may start in the middle of an instruction, so the delta instructions are run for the whole bundle at once.
+    base=archive.openFile(sourcePath[0])
+    delta=archive.openFile(sourcePath[1])
+    base.seek(bundle.basePayloadOffset)
+    delta.seek(bundle.deltaPayloadOffset)
+    payloads=[(targetPath if targetPath and not isExtracted(targetPath) else None, entry.originalSize)
+              for entry, targetPath in zip(bundle.entries,targetPaths)]
+    f2=BundleOutput(payloads)
+    try:
+        patchPayload(base,delta,bundle.deltaEof,sum(entry.originalSize for entry in bundle.entries),f2)
+    finally:
+        f2.close()
+        base.close()
+        delta.close()
     return True
 
 def noncasChunkPayload(entry,targetPath,sourcePath):
-    if os.path.isfile(lp(targetPath)): return True
+    if isExtracted(targetPath): return True
     decompressPayload(sourcePath,entry.get("offset"),entry.get("size"),None,targetPath)
     return True
 
 
+def locatePayload(task):
+    #Return (archive path, offset, size) of the data an extraction task (writePayload, entry, targetPath[, sourcePath]) reads,
+    #or None if it's not known. Patched payloads are located by their base data which is usually the bigger part.
+    writePayload, entry = task[0], task[1]
+    if writePayload==casPatchedBundlePayload and entry.get("casPatchType")==2:
+        sha1=entry.get("baseSha1")
+    elif writePayload in (casBundlePayload,casPatchedBundlePayload,casChunkPayload):
+        sha1=entry.get("sha1")
+    elif writePayload==noncasChunkPayload:
+        return task[3], entry.get("offset"), entry.get("size")
+    else:
+        return None
+
+    if sha1 not in cas.catDict: return None
+    catEntry=cas.catDict[sha1]
+    return catEntry.path, catEntry.offset, catEntry.size
+
+
+def describePayload(task):
+    #Return what an extraction task writes as a tuple of plain values, used to tell if a bundle changed since the last dump,
+    #and whether its data can be found in the cats.
+    writePayload, entry, targetPath = task[0], task[1], task[2]
+    if writePayload in (casBundlePayload,casPatchedBundlePayload,casChunkPayload):
+        if writePayload==casPatchedBundlePayload and entry.get("casPatchType")==2:
+            sha1s=entry.get("baseSha1"), entry.get("deltaSha1")
+        else:
+            sha1s=entry.get("sha1"),
+        values=targetPath, sha1s, entry.get("originalSize"), entry.get("logicalOffset"), entry.get("logicalSize")
+        return values, all(sha1 in cas.catDict for sha1 in sha1s)
+    elif writePayload==noncasChunkPayload:
+        return (targetPath, entry.get("offset"), entry.get("size")), True
+    else:
+        return (targetPath, getattr(entry,"sha1",None), entry.originalSize), True
+
+
 
 def zstdInit():
     #Load Zstd compression dictionary.
-    global zstd_dict
-
-    f=open(r"..\misc\zstdDict.bin","rb")
+    f=open(os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","misc","zstdDict.bin"),"rb")
     data=f.read()
     f.close()
-    zstd_dict=ctypes.c_void_p(libzstd.ZSTD_createDDict(data,len(data)))
+    for backend in codec.backends[0x0f]:
+        backend.loadDict(data)
 
 def zstdCleanup():
-    libzstd.ZSTD_freeDDict(zstd_dict)
+    with allContextsLock:
+        for ctx in allContexts:
+            ctx.close()
+        allContexts.clear()
+    for backend in codec.backends[0x0f]:
+        backend.freeDict()
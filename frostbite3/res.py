@@ -11,7 +11,7 @@ unkResTypes=list()
 
 def loadResNames():
     #Load known res type names from the list into types table.
-    f=open(r"..\misc\resnames.txt","r")
+    f=open(os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","misc","resnames.txt"),"r")
     data=f.read()
     f.close()
     lines=data.splitlines()
@@ -103,3 +103,15 @@ def cacheNewWaveResources(bigEndian):
             newWaves[guid]=val
 
     newWavesCached=True
+
+def loadUnknownResTypes(dumpFolder):
+    path=os.path.join(dumpFolder,"unknownResTypes.txt")
+    if not os.path.isfile(path):
+        return
+
+    f=open(path,"r")
+    for line in f.read().splitlines():
+        typ=int(line,16)
+        if typ not in resTypes and typ not in unkResTypes:
+            unkResTypes.append(typ)
+    f.close()